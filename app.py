@@ -1,15 +1,31 @@
-import requests
 from flask import Flask, request, Response, jsonify
-from functions import generate_response, generate_response_with_rag, chunk_and_store, manage_chat_history, get_chat_history
+from functions import generate_response, generate_response_with_rag, ingest_document, generate_file_hash, manage_chat_history, get_chat_history
+from functions import claim_update, release_update
+import metrics
+from jobs import JobQueue
+from telegram_client import MessageStream, TelegramClient
+from updates import ChatLocks, ChatScheduler
 from dotenv import load_dotenv
 import os
-import threading
 
 load_dotenv()
 
 app = Flask(__name__)
 
 TELEGRAM_BOT_TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN')
+telegram = TelegramClient(TELEGRAM_BOT_TOKEN)
+
+# "sync" answers inside the webhook request; "async" acknowledges Telegram immediately
+# and answers from a pool of WEBHOOK_WORKERS threads
+WEBHOOK_MODE = os.environ.get('WEBHOOK_MODE', 'sync')
+
+# With STREAM_RESPONSES=1 answers are shown while Gemini is still generating them
+STREAM_RESPONSES = os.environ.get('STREAM_RESPONSES', '0') == '1'
+
+# In async mode an answer is dropped when newer messages arrive before it is sent, and the question
+# is answered together with them instead, but at most this many times so a chatty user still gets replies
+MAX_STALE_RESTARTS = int(os.environ.get('MAX_STALE_RESTARTS', 1))
+COMMANDS = ('/status', '/chatid')
 
 # print("STARTING", TELEGRAM_BOT_TOKEN, GOOGLE_API_KEY)
 
@@ -30,57 +46,86 @@ def message_parser(message):
         chat_id = -1
         text = '__NONE__'
         file_id = None
-    
-    print("Chat ID: ", chat_id)
-    print("Message: ", text)
-    print("File ID: ", file_id)
-    
+
+    if metrics.sampled():
+        metrics.log_event("update", chat_id=chat_id, text_chars=len(text), has_document=file_id is not None)
+
     return chat_id, text, file_id
 
 def download_document(file_id):
-    file_info_url = f'https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/getFile?file_id={file_id}'
-    file_info_response = requests.get(file_info_url).json()
-    
-    if 'result' in file_info_response:
-        file_path = file_info_response['result']['file_path']
-        download_url = f'https://api.telegram.org/file/bot{TELEGRAM_BOT_TOKEN}/{file_path}'
-        
-        # Download the file
-        response = requests.get(download_url)
-        
-        # Save the file locally
-        file_name = os.path.join('/', os.path.basename(file_path))
-        with open(file_name, 'wb') as f:
-            f.write(response.content)
-        print("File saved as:", file_name)
-        return file_name
-    return None
+    # Streamed to a unique file under DOWNLOAD_DIR, which stays put until the job queue is done with it
+    file_name = telegram.download_file(file_id)
+    if file_name:
+        metrics.log_event("document_downloaded", file_name=file_name)
+    return file_name
 
-def process_document_async(file_path, chat_id):
+def remove_document(file_path, chat_id):
+    try:
+        os.remove(file_path)
+    except Exception as e:
+        send_message_telegram(chat_id, f"Error deleting file: {e}")
+
+def process_document_job(job, final_attempt):
+    chat_id = int(job['chat_id'])
+    file_path = job['file_path']
     try:
         # Process and store document chunks
-        chunk_msg = chunk_and_store(file_path, chat_id)
-        send_message_telegram(chat_id, f"Document processed successfully: {chunk_msg}")
+        chunk_msg = ingest_document(
+            file_path, chat_id,
+            progress=lambda text: send_message_telegram(chat_id, text),
+            file_hash=job['file_hash']
+        )
     except Exception as e:
-        send_message_telegram(chat_id, f"Error processing document: {e}")
-    finally:
-        # Attempt to delete the file 
-        try:
-            os.remove(file_path)
-            print("Deleting", file_path)
-        except Exception as e:
-            send_message_telegram(chat_id, f"Error deleting file: {e}")
+        if final_attempt:
+            send_message_telegram(chat_id, f"Error processing document: {e}")
+            remove_document(file_path, chat_id)
+        else:
+            send_message_telegram(chat_id, f"Error processing document, retrying shortly: {e}")
+        raise
+    send_message_telegram(chat_id, f"Document processed successfully: {chunk_msg}")
+    remove_document(file_path, chat_id)
+
+# Uploads are processed by a bounded pool of workers from a persistent queue,
+# so they survive restarts and can't crowd out webhook handling
+document_jobs = JobQueue(process_document_job)
+document_jobs.start()
+
+def format_job_status(jobs):
+    if not jobs:
+        return "You haven't sent me any documents yet."
+    lines = []
+    for job in jobs:
+        line = f"Document {job['file_hash'][:8]}: {job['status']} (attempt {job['attempts']})"
+        if job['status'] != 'done' and job['error']:
+            line += f" - last error: {job['error']}"
+        lines.append(line)
+    return "\n".join(lines)
 
 def send_message_telegram(chat_id, text):
     manage_chat_history(chat_id, text, 'bot')
-    url = f'https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage'
-    payload = {
-        'chat_id': chat_id,
-        'text': text,
-        'parse_mode' : 'Markdown'
-    }
-    response = requests.post(url, json=payload)
-    return response
+    with metrics.timer("send"):
+        return telegram.send_message(chat_id, text)
+
+def answer_question(chat_id, question, cancelled=None):
+    # Returns None, having sent nothing, if cancelled() turned true before the answer went out
+    if not STREAM_RESPONSES:
+        answer = generate_response_with_rag(question, chat_id, cancelled=cancelled)
+        if answer is None:
+            return None
+        if cancelled and cancelled():
+            metrics.increment("cancelled_total", before="send")
+            return None
+        return send_message_telegram(chat_id, answer)
+
+    # Post the answer as it is generated and edit it in place until it's complete.
+    # Once the first part is shown the answer is finished even if it went stale.
+    stream = MessageStream(telegram, chat_id)
+    answer = generate_response_with_rag(question, chat_id, on_partial=stream.update, cancelled=cancelled)
+    if answer is None:
+        return None
+    manage_chat_history(chat_id, answer, 'bot')
+    with metrics.timer("send"):
+        return stream.finish(answer)
 
 @app.route('/hello', methods=['GET'])
 def hello():
@@ -90,67 +135,156 @@ def hello():
         # return generate_response("what is your name", llm)
         # return f"{TELEGRAM_BOT_TOKEN} and {GOOGLE_API_KEY}"
     except Exception as e:
-        print("OOPS SOMETHING WENT WRONG WITH GENERATE RESPONSE", e)
+        metrics.log_error("hello_failed", e)
     return "Hello world"
 
     
+def handle_update(chat_id, incoming_que, file_id):
+    if chat_id != -1:
+        if incoming_que.strip() and not file_id:
+            try: 
+                manage_chat_history(chat_id, incoming_que, "user")
+            except Exception as e:
+                send_message_telegram(chat_id, f"Error managing chat history: {e}")
+                return Response('Failed to manage chat history', status=500)
+            
+        if file_id:
+            # Try downloading the document
+            try:
+                file_path = download_document(file_id)
+                if file_path:
+                    # Queue the document for the background workers
+                    job, created = document_jobs.enqueue(chat_id, file_path, generate_file_hash(file_path))
+
+                    # Immediately return a 200 OK response
+                    if created:
+                        send_message_telegram(chat_id, "Please wait while the document is being processed")
+                    else:
+                        if file_path != job['file_path']:
+                            os.remove(file_path)
+                        if job['status'] == 'done':
+                            send_message_telegram(chat_id, "This document has already been processed.")
+                        else:
+                            send_message_telegram(chat_id, "This document is already being processed.")
+                else:
+                    send_message_telegram(chat_id, "Failed to save the document.")
+            except Exception as e:
+                send_message_telegram(chat_id, f"Error handling document download: {e}")
+
+        elif incoming_que.strip() == '/status':
+            try:
+                send_message_telegram(chat_id, format_job_status(document_jobs.status(chat_id)))
+            except Exception as e:
+                send_message_telegram(chat_id, f"Error fetching document status: {e}")
+                return Response('Failed to send document status', status=500)
+
+        elif incoming_que.strip() == '/chatid':
+            try:
+                send_message_telegram(chat_id, f'Your chat ID is: {chat_id}')
+            except Exception as e:
+                send_message_telegram(chat_id, f"Error sending chat ID: {e}")
+                return Response('Failed to send chat ID', status=500)
+        else:
+            try:
+                # answer = generate_response(incoming_que, llm)
+                answer_question(chat_id, incoming_que)
+            except Exception as e:
+                send_message_telegram(chat_id, f"Error generating or sending response: {e}")
+                return Response('Failed to send response', status=500)
+    
+    return Response('ok', status=200)
+
+def is_question(update):
+    return not update['file_id'] and update['text'].strip() not in COMMANDS
+
+
+def handle_updates(chat_id, updates, stale):
+    # Scheduler handler for async mode. Documents and commands are handled one by one, in order;
+    # consecutive questions get one answer. Returns the updates to retry along with newer ones.
+    i = 0
+    while i < len(updates):
+        if not is_question(updates[i]):
+            handle_update(chat_id, updates[i]['text'], updates[i]['file_id'])
+            i += 1
+            continue
+
+        group = []
+        while i < len(updates) and is_question(updates[i]):
+            group.append(updates[i])
+            i += 1
+        for update in group:
+            if update['text'].strip() and not update.get('recorded'):
+                manage_chat_history(chat_id, update['text'], "user")
+                update['recorded'] = True
+
+        # Only the last answer can be overtaken by messages that aren't in this batch
+        cancellable = i == len(updates) and all(u.get('restarts', 0) < MAX_STALE_RESTARTS for u in group)
+        try:
+            sent = answer_question(chat_id, "\n".join(u['text'] for u in group), cancelled=stale if cancellable else None)
+        except Exception as e:
+            send_message_telegram(chat_id, f"Error generating or sending response: {e}")
+            continue
+        if sent is None:
+            for update in group:
+                update['restarts'] = update.get('restarts', 0) + 1
+            return group
+    return None
+
+
+# Async mode answers from a pool of workers, one batch per chat at a time; sync mode answers
+# inside the request, holding the chat's lock so a chat's messages are still handled in order
+chat_scheduler = ChatScheduler(handle_updates)
+chat_locks = ChatLocks()
+if WEBHOOK_MODE == 'async':
+    chat_scheduler.start()
+
+
 @app.route('/', methods=['GET', 'POST'])
 def index():
     if request.method == 'POST':
         try:
-            msg = request.get_json()
-            chat_id, incoming_que, file_id = message_parser(msg)
+            with metrics.timer("parse"):
+                msg = request.get_json()
+                chat_id, incoming_que, file_id = message_parser(msg)
         except Exception as e:
             error_msg = f"Error parsing message: {e}"
             if 'chat_id' in locals():
                 send_message_telegram(chat_id, error_msg)
             return Response('Failed to parse message', status=400)
-        
-        if chat_id != -1:
-            if incoming_que.strip() and not file_id:
-                try: 
-                    manage_chat_history(chat_id, incoming_que, "user")
-                except Exception as e:
-                    send_message_telegram(chat_id, f"Error managing chat history: {e}")
-                    return Response('Failed to manage chat history', status=500)
-                
-            if file_id:
-                # Try downloading the document
-                try:
-                    file_path = download_document(file_id)
-                    if file_path:
-                        # Start an asynchronous thread to process the document
-                        threading.Thread(
-                            target=process_document_async, 
-                            args=(file_path, chat_id), 
-                            daemon=True
-                        ).start()
-                        
-                        # Immediately return a 200 OK response
-                        send_message_telegram(chat_id, "Please wait while the document is being processed")
-                    else:
-                        send_message_telegram(chat_id, "Failed to save the document.")
-                except Exception as e:
-                    send_message_telegram(chat_id, f"Error handling document download: {e}")
-
-            elif incoming_que.strip() == '/chatid':
-                try:
-                    send_message_telegram(chat_id, f'Your chat ID is: {chat_id}')
-                except Exception as e:
-                    send_message_telegram(chat_id, f"Error sending chat ID: {e}")
-                    return Response('Failed to send chat ID', status=500)
-            else:
-                try:
-                    # answer = generate_response(incoming_que, llm)
-                    answer = generate_response_with_rag(incoming_que, chat_id)
-                    send_message_telegram(chat_id, answer)
-                except Exception as e:
-                    send_message_telegram(chat_id, f"Error generating or sending response: {e}")
-                    return Response('Failed to send response', status=500)
-        
-        return Response('ok', status=200)
+
+        # Telegram redelivers updates it thinks failed; answer each update_id only once
+        update_id = msg.get('update_id') if isinstance(msg, dict) else None
+        if update_id is not None and not claim_update(update_id):
+            return Response('ok', status=200)
+        if chat_id == -1:
+            return Response('ok', status=200)
+
+        if WEBHOOK_MODE == 'async':
+            # Acknowledge right away and answer out of band
+            if not chat_scheduler.submit(chat_id, {'text': incoming_que, 'file_id': file_id}):
+                release_update(update_id)
+                return Response('Busy', status=503)
+            return Response('ok', status=200)
+
+        try:
+            with metrics.timer("webhook"), chat_locks.hold(chat_id):
+                response = handle_update(chat_id, incoming_que, file_id)
+        except Exception:
+            release_update(update_id)
+            raise
+        # A failed update is redelivered by Telegram, so let the redelivery through
+        if response.status_code != 200:
+            release_update(update_id)
+        return response
     else:
         return "<h1>GET Request Made</h1>"
 
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    # Prometheus text format: per-stage latency histograms, error counters and cache hit rates
+    metrics.set_gauge("update_queue_depth", chat_scheduler.pending())
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 if __name__ == '__main__':
     app.run(host='127.0.0.1', port=8000)
\ No newline at end of file
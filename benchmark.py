@@ -0,0 +1,237 @@
+# Offline latency and throughput benchmark. Replays the evaluation questions against the bot
+# with every external service replaced by a local fake (see benchmark_stubs.py).
+# Needs the development requirements: pip install -r requirements-dev.txt
+#
+#   python benchmark.py                               # 8 concurrent chats through generate_response_with_rag
+#   python benchmark.py --target webhook              # POST Telegram updates to the Flask index route
+#   python benchmark.py --concurrency 32 --repeat 3   # more load; repeats exercise the caches
+#   python benchmark.py --gemini-latency 2 --web-latency 3
+#   python benchmark.py --startup --runs 5            # import time and first-request latency
+#
+# Each simulated chat sends its next question as soon as the previous one is answered. The report
+# gives end-to-end latency percentiles, throughput, and the same percentiles for every stage
+# recorded in the RAG trace. The webhook target answers inside the request (WEBHOOK_MODE=sync),
+# so request latency is answer latency.
+#
+# --startup measures cold starts instead: each run is a fresh interpreter that imports the app,
+# optionally runs the warm-up hook, and sends two questions. It is run with and without warm-up.
+# With stubbed services warm-up can only show the import and local setup it moves off the first
+# request; connection setup to the real services comes on top of that.
+import argparse
+import csv
+import itertools
+import json
+import os
+import queue
+import subprocess
+import sys
+import threading
+import time
+
+import numpy as np
+
+import metrics
+from benchmark_stubs import Latencies, configure_environment, install
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+TRIVIA_CSV = os.path.join(HERE, "evaluation", "harry-potter-trivia-ai-100.csv")
+CONVERSATION_CSV = os.path.join(HERE, "evaluation", "conversation.csv")
+CHARACTER = "Harry Potter"
+FIRST_CHAT_ID = 1000
+
+
+def load_questions():
+    questions, passages = [], []
+    with open(TRIVIA_CSV, newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            questions.append(row["question"])
+            passages.append(f"{row['question']} {row['answer']}.")
+    with open(CONVERSATION_CSV, newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            questions.append(row["Question"])
+            passages.append(row["Answer"].strip())
+    return questions, passages
+
+
+def seed_chat(functions, chat_id, passages):
+    # What an uploaded book would have left behind: a character, the corpus, its keyword index
+    functions.collection("character").update_one({"chat_id": chat_id}, {"$set": {"last_character": CHARACTER}}, upsert=True)
+    ids = [f"bench{i}" for i in range(len(passages))]
+    vector_store = functions.initialize_vector_store(chat_id)
+    vector_store.add_texts(passages, metadatas=[{"source": "benchmark", "page": i} for i in range(len(passages))], ids=ids)
+    if functions.keyword_index:
+        from langchain_core.documents import Document
+        documents = [Document(page_content=text, metadata={"source": "benchmark", "page": i}) for i, text in enumerate(passages)]
+        functions.keyword_index.add(chat_id, ids, documents)
+    functions.record_corpus_file(chat_id, "benchmark")
+
+
+def percentiles(values):
+    if not values:
+        return "n/a"
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return f"p50={p50 * 1000:7.0f}ms  p95={p95 * 1000:7.0f}ms  p99={p99 * 1000:7.0f}ms  (n={len(values)})"
+
+
+def startup_run(latencies, warm_up):
+    # One cold start in this (fresh) interpreter; prints its timings as JSON
+    timings = {}
+    workdir = configure_environment()
+    start = time.perf_counter()
+    import functions
+    timings["import_functions"] = time.perf_counter() - start
+    start = time.perf_counter()
+    import app
+    timings["import_app"] = time.perf_counter() - start
+    install(latencies, workdir)
+    metrics.logger.disabled = True
+    if warm_up:
+        start = time.perf_counter()
+        functions.warm_up()
+        timings["warm_up"] = time.perf_counter() - start
+
+    functions.collection("character").insert_one({"chat_id": FIRST_CHAT_ID, "last_character": CHARACTER})
+    questions, _ = load_questions()
+    client = app.app.test_client()
+    stdout, sys.stdout = sys.stdout, open(os.devnull, "w")
+    try:
+        for update_id, label in enumerate(("first_request", "second_request"), 1):
+            start = time.perf_counter()
+            client.post("/", json={
+                "update_id": update_id,
+                "message": {"chat": {"id": FIRST_CHAT_ID}, "text": questions[update_id]},
+            })
+            timings[label] = time.perf_counter() - start
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    print(json.dumps(timings))
+
+
+def startup_benchmark(args, latency_args):
+    for warm_up in (False, True):
+        runs = []
+        for _ in range(args.runs):
+            command = [sys.executable, os.path.abspath(__file__), "--startup-run", *latency_args]
+            if warm_up:
+                command.append("--warm-up")
+            output = subprocess.run(command, capture_output=True, text=True, check=True).stdout
+            runs.append(json.loads(output.strip().splitlines()[-1]))
+        print(f"{'With' if warm_up else 'Without'} warm-up, median of {args.runs} cold starts:")
+        for step in runs[0]:
+            print(f"  {step:<20}{np.median([run[step] for run in runs]) * 1000:7.0f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay the evaluation questions against stubbed services")
+    parser.add_argument("--target", choices=["rag", "webhook"], default="rag")
+    parser.add_argument("--concurrency", type=int, default=8, help="simultaneous chats")
+    parser.add_argument("--repeat", type=int, default=1, help="times the question set is replayed")
+    parser.add_argument("--limit", type=int, help="only the first N questions")
+    parser.add_argument("--verbose", action="store_true", help="keep the bot's own logging")
+    parser.add_argument("--startup", action="store_true", help="measure cold starts instead of load")
+    parser.add_argument("--runs", type=int, default=5, help="cold starts per --startup variant")
+    parser.add_argument("--startup-run", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--warm-up", action="store_true", help=argparse.SUPPRESS)
+    defaults = Latencies()
+    for name in vars(defaults):
+        parser.add_argument(f"--{name}-latency", type=float, default=getattr(defaults, name),
+                            help=f"seconds per {name} call (default {getattr(defaults, name)})")
+    args = parser.parse_args()
+
+    latencies = Latencies(**{name: getattr(args, f"{name}_latency") for name in vars(defaults)})
+    os.environ["WEBHOOK_MODE"] = "sync"
+    if args.startup_run:
+        startup_run(latencies, args.warm_up)
+        return
+    if args.startup:
+        latency_args = [f"--{name}-latency={getattr(latencies, name)}" for name in vars(defaults)]
+        startup_benchmark(args, latency_args)
+        return
+
+    functions, app = install(latencies)
+
+    questions, passages = load_questions()
+    questions = questions[:args.limit] * args.repeat
+    chat_ids = [FIRST_CHAT_ID + i for i in range(args.concurrency)]
+    for chat_id in chat_ids:
+        seed_chat(functions, chat_id, passages)
+
+    stages, degraded, stage_lock = {}, {}, threading.Lock()
+    record_trace = functions.record_trace
+
+    def collect_trace(trace):
+        with stage_lock:
+            for stage, seconds in trace["timings"].items():
+                stages.setdefault(stage, []).append(seconds)
+            for source in trace["degraded"]:
+                degraded[source] = degraded.get(source, 0) + 1
+        record_trace(trace)
+    functions.record_trace = collect_trace
+
+    work = queue.Queue()
+    for question in questions:
+        work.put(question)
+    latencies_by_request, errors, result_lock = [], [], threading.Lock()
+    update_ids = itertools.count(1)
+
+    def ask(client, chat_id, question):
+        if args.target == "rag":
+            functions.generate_response_with_rag(question, chat_id)
+            return
+        response = client.post("/", json={
+            "update_id": next(update_ids),
+            "message": {"chat": {"id": chat_id}, "text": question},
+        })
+        if response.status_code != 200:
+            raise RuntimeError(f"webhook returned {response.status_code}")
+
+    def simulate_chat(chat_id):
+        client = app.app.test_client()
+        while True:
+            try:
+                question = work.get_nowait()
+            except queue.Empty:
+                return
+            start = time.perf_counter()
+            try:
+                ask(client, chat_id, question)
+            except Exception as e:
+                with result_lock:
+                    errors.append(f"{question!r}: {e}")
+                continue
+            with result_lock:
+                latencies_by_request.append(time.perf_counter() - start)
+
+    stdout = sys.stdout
+    if not args.verbose:
+        sys.stdout = open(os.devnull, "w")
+        metrics.logger.disabled = True
+    try:
+        started = time.perf_counter()
+        threads = [threading.Thread(target=simulate_chat, args=(chat_id,)) for chat_id in chat_ids]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+    finally:
+        if sys.stdout is not stdout:
+            sys.stdout.close()
+            sys.stdout = stdout
+
+    print(f"Target: {args.target}, {args.concurrency} concurrent chats, {len(questions)} questions")
+    print(f"Latencies: {latencies}")
+    print(f"Completed {len(latencies_by_request)} in {elapsed:.1f}s "
+          f"({len(latencies_by_request) / elapsed:.2f} answers/s), {len(errors)} errors")
+    print(f"{'end-to-end':<20}{percentiles(latencies_by_request)}")
+    for stage in sorted(stages):
+        print(f"{stage:<20}{percentiles(stages[stage])}")
+    for source, count in sorted(degraded.items()):
+        print(f"{source} timed out or failed {count} times")
+    for error in errors[:5]:
+        print("Error:", error)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+# Local stand-ins for every service the bot talks to, used by benchmark.py.
+#
+# install() must run before functions/app are imported: configure_environment() points the
+# on-disk stores at a scratch directory and picks the local vector backend, then the modules are
+# imported and their Gemini, Mongo, embeddings, web search and Telegram clients swapped for the
+# fakes below.
+# Every fake sleeps for its configured latency, so the bot's own overhead and concurrency
+# behaviour are measured against realistic upstream timings without any network.
+import hashlib
+import itertools
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from dataclasses import dataclass
+
+import numpy as np
+import requests
+
+from telegram_client import TelegramClient
+
+WORD = re.compile(r"\w+")
+
+
+@dataclass
+class Latencies:
+    # Seconds per call
+    gemini: float = 0.8
+    classifier: float = 0.3
+    embed: float = 0.1
+    vector: float = 0.05
+    web: float = 1.0
+    mongo: float = 0.005
+    telegram: float = 0.05
+
+
+class FakeResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeGenerativeModel:
+    # generate_content like genai.GenerativeModel: the whole answer after latency seconds,
+    # or with stream=True the same answer in chunks spread over that time
+    def __init__(self, latency, answer, chunks=8):
+        self.latency = latency
+        self.answer = answer
+        self.chunks = chunks
+
+    def generate_content(self, prompt, stream=False):
+        text = self.answer(prompt) if callable(self.answer) else self.answer
+        if not stream:
+            time.sleep(self.latency)
+            return FakeResponse(text)
+        return self._stream(text)
+
+    def _stream(self, text):
+        size = max(len(text) // self.chunks, 1)
+        for start in range(0, len(text), size):
+            time.sleep(self.latency / self.chunks)
+            yield FakeResponse(text[start:start + size])
+
+
+class HashingEmbeddings:
+    # Bag-of-words hashed into a fixed number of dimensions: deterministic, and texts that share
+    # words land close together, so retrieval over the benchmark corpus behaves plausibly
+    def __init__(self, latency, size=768):
+        self.latency = latency
+        self.size = size
+
+    def _embed(self, text):
+        vector = np.zeros(self.size, dtype=np.float32)
+        for word in WORD.findall(text.lower()):
+            vector[int(hashlib.md5(word.encode()).hexdigest(), 16) % self.size] += 1.0
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def embed_documents(self, texts):
+        time.sleep(self.latency)
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text):
+        time.sleep(self.latency)
+        return self._embed(text)
+
+
+class SlowCollection:
+    # Delegates to a mongomock collection, sleeping before every method call
+    def __init__(self, collection, latency):
+        self._collection = collection
+        self._latency = latency
+
+    def __getattr__(self, name):
+        attr = getattr(self._collection, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            time.sleep(self._latency)
+            return attr(*args, **kwargs)
+        return call
+
+
+class SlowMongoClient:
+    # client[db][collection] hands out SlowCollections over one in-memory mongomock client
+    def __init__(self, latency):
+        import mongomock
+        self._client = mongomock.MongoClient()
+        self._latency = latency
+        self.admin = self._client.admin
+
+    def __getitem__(self, db_name):
+        return SlowDatabase(self._client[db_name], self._latency)
+
+
+class SlowDatabase:
+    def __init__(self, db, latency):
+        self._db = db
+        self._latency = latency
+
+    def __getitem__(self, name):
+        return SlowCollection(self._db[name], self._latency)
+
+
+def slow_vector_store(base, latency):
+    # LocalVectorStore with a round-trip to a remote index added to every search and upsert
+    class SlowVectorStore(base):
+        def add_texts(self, *args, **kwargs):
+            time.sleep(latency)
+            return super().add_texts(*args, **kwargs)
+
+        def similarity_search_by_vector_with_score(self, *args, **kwargs):
+            time.sleep(latency)
+            return super().similarity_search_by_vector_with_score(*args, **kwargs)
+    return SlowVectorStore
+
+
+class FakeTelegramClient(TelegramClient):
+    # The real client with the HTTP layer replaced: every call succeeds after latency seconds
+    # and is recorded in sent
+    def __init__(self, token, latency):
+        super().__init__(token)
+        self.latency = latency
+        self.sent = []
+        self._message_ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def _request(self, method, url, retry_rate_limit=True, **kwargs):
+        time.sleep(self.latency)
+        api_method = url.rsplit('/', 1)[-1]
+        with self._lock:
+            self.sent.append((api_method, kwargs.get("json")))
+        response = requests.models.Response()
+        response.status_code = 200
+        response._content = json.dumps({"ok": True, "result": {"message_id": next(self._message_ids)}}).encode()
+        return response
+
+
+def default_answer(prompt):
+    return ("Right, well, that's a good question. From what I remember at Hogwarts, it's all in the books "
+            "if you know where to look. ") * 4
+
+
+def configure_environment(workdir=None):
+    workdir = workdir or tempfile.mkdtemp(prefix="llm-chatbot-bench-")
+    os.environ.update({
+        "VECTOR_BACKEND": "local",
+        "LOCAL_VECTOR_DIR": os.path.join(workdir, "vectors"),
+        "EMBEDDING_CACHE_PATH": os.path.join(workdir, "embedding_cache.sqlite3"),
+        "KEYWORD_INDEX_PATH": os.path.join(workdir, "keyword_index.sqlite3"),
+        "JOBS_DB_PATH": os.path.join(workdir, "jobs.sqlite3"),
+        "DOWNLOAD_DIR": os.path.join(workdir, "downloads"),
+        "WEB_SEARCH_PROVIDER": "fake",
+    })
+    for name in ("GEMINI_API_KEY", "PINECONE_API_KEY", "TELEGRAM_BOT_TOKEN"):
+        os.environ.setdefault(name, "benchmark")
+    return workdir
+
+
+def install(latencies, workdir=None, answer=default_answer, web_answer="Hogwarts School of Witchcraft and Wizardry."):
+    # Returns (functions, app) wired to the fakes, with all on-disk state under workdir
+    configure_environment(workdir)
+    import functions
+    import app
+    from clients import Limited
+    import local_vector_store
+    from embedding_cache import CachedEmbeddings, EmbeddingCache
+    from web_search import FakeProvider, WebSearch
+
+    functions.llm.set(FakeGenerativeModel(latencies.gemini, answer))
+    functions.classifier.set(FakeGenerativeModel(latencies.classifier, '"None"'))
+    functions.summarizer.set(FakeGenerativeModel(latencies.gemini, "The user asked about the books."))
+    functions.mongo.set(SlowMongoClient(latencies.mongo))
+    functions.embeddings.set(CachedEmbeddings(
+        Limited(HashingEmbeddings(latencies.embed), "gemini", ["embed_documents", "embed_query"]), EmbeddingCache(os.environ["EMBEDDING_CACHE_PATH"]),
+        model=functions.EMBEDDING_MODEL, task_type=functions.EMBEDDING_TASK_TYPE
+    ))
+    # Nothing to reach in the local backend
+    functions.pinecone.set(object())
+    # build_vector_store imports it from the module when it first builds a chat's store
+    local_vector_store.LocalVectorStore = slow_vector_store(local_vector_store.LocalVectorStore, latencies.vector)
+    functions.web_search = WebSearch(FakeProvider(default=web_answer, latency=latencies.web))
+
+    app.telegram = FakeTelegramClient(os.environ["TELEGRAM_BOT_TOKEN"], latencies.telegram)
+    return functions, app
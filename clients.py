@@ -0,0 +1,98 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
+
+import metrics
+
+# Every lazily built client in the process, so warm_up() can build them all up front
+lazy_clients = {}
+
+# Calls in flight per upstream across the whole process. A call over the limit waits for a slot
+# rather than failing, keeping bursts under the provider's quota. Web search is bounded by
+# WEB_SEARCH_CONCURRENCY in web_search.py.
+UPSTREAM_LIMITS = {
+    "gemini": int(os.environ.get('GEMINI_CONCURRENCY', 16)),
+    "pinecone": int(os.environ.get('PINECONE_CONCURRENCY', 32)),
+}
+_upstream_slots = {name: threading.BoundedSemaphore(limit) for name, limit in UPSTREAM_LIMITS.items()}
+
+
+class LazyClient:
+    # Builds an expensive client (and imports its library) on first use instead of at import time.
+    # Safe to call from many threads: the factory runs once, and a failed build is retried on the
+    # next call. Each client has its own lock, so a hung endpoint only blocks callers of that client.
+
+    def __init__(self, name, factory):
+        self.name = name
+        self._factory = factory
+        self._client = None
+        self._lock = threading.Lock()
+        lazy_clients[name] = self
+
+    def get(self):
+        client = self._client
+        if client is not None:
+            return client
+        with self._lock:
+            if self._client is None:
+                start = time.perf_counter()
+                self._client = self._factory()
+                metrics.observe(f"init_{self.name}", time.perf_counter() - start)
+            return self._client
+
+    def set(self, client):
+        # Replace the client, e.g. with a stand-in for benchmarks
+        with self._lock:
+            self._client = client
+
+    @property
+    def ready(self):
+        return self._client is not None
+
+
+def warm_up(clients=None, timeout=10.0, extra=()):
+    # Builds the given clients (default: all of them) and runs the extra callables in parallel,
+    # waiting at most timeout seconds. Anything unfinished is left to complete in the background
+    # or to be built on first use. Returns the names of the steps that did not finish cleanly.
+    steps = {client.name: client.get for client in (clients or list(lazy_clients.values()))}
+    steps.update({step.__name__: step for step in extra})
+    pool = ThreadPoolExecutor(max_workers=max(len(steps), 1), thread_name_prefix="warm-up")
+    futures = {pool.submit(step): name for name, step in steps.items()}
+    done, not_done = wait(futures, timeout=timeout)
+    pool.shutdown(wait=False)
+
+    failed = [futures[future] for future in not_done]
+    for future in done:
+        if future.exception() is not None:
+            metrics.log_error("warm_up_failed", future.exception(), step=futures[future])
+            failed.append(futures[future])
+    return failed
+
+
+@contextmanager
+def upstream(name):
+    # Holds one of the upstream's slots for the duration of the block
+    start = time.perf_counter()
+    with _upstream_slots[name]:
+        metrics.observe(f"wait_{name}", time.perf_counter() - start)
+        yield
+
+
+class Limited:
+    # Proxy that runs the named methods of client under upstream(name)
+    def __init__(self, client, name, methods):
+        self._client = client
+        self._name = name
+        self._methods = set(methods)
+
+    def __getattr__(self, attr):
+        value = getattr(self._client, attr)
+        if attr not in self._methods:
+            return value
+
+        def call(*args, **kwargs):
+            with upstream(self._name):
+                return value(*args, **kwargs)
+        return call
@@ -0,0 +1,128 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from array import array
+
+from langchain_core.embeddings import Embeddings
+
+from caching import caches
+
+EMBEDDING_CACHE_PATH = os.environ.get('EMBEDDING_CACHE_PATH', 'embedding_cache.sqlite3')
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.environ.get('EMBEDDING_CACHE_MAX_ENTRIES', 500000))
+
+# SQLite caps the number of bound parameters per statement
+LOOKUP_BATCH = 500
+
+
+def embedding_key(text, model, task_type):
+    # Content address for one embedding: the chunk text plus everything that changes the vector
+    return hashlib.sha256(f"{model}\x00{task_type}\x00{text}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    # Persistent, size-bounded store of embeddings keyed by embedding_key().
+    # Least recently used entries are evicted once max_entries is exceeded.
+
+    def __init__(self, path=EMBEDDING_CACHE_PATH, max_entries=EMBEDDING_CACHE_MAX_ENTRIES, name="embeddings"):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        caches[name] = self
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            " key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self._conn.commit()
+
+    def get_many(self, keys):
+        # Returns {key: vector} for the keys that are cached, in one query per LOOKUP_BATCH keys
+        found = {}
+        now = time.time()
+        with self._lock:
+            for start in range(0, len(keys), LOOKUP_BATCH):
+                batch = keys[start:start + LOOKUP_BATCH]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", batch
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = array("f", blob).tolist()
+                if rows:
+                    self._conn.executemany(
+                        "UPDATE embeddings SET last_used = ? WHERE key = ?", [(now, key) for key, _ in rows]
+                    )
+            self._conn.commit()
+            self.hits += len(found)
+            self.misses += len(set(keys)) - len(found)
+        return found
+
+    def put_many(self, items):
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)",
+                [(key, array("f", vector).tobytes(), now) for key, vector in items.items()]
+            )
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        # Caller holds the lock
+        (count,) = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+        excess = count - self.max_entries
+        if excess > 0:
+            self._conn.execute(
+                "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY last_used LIMIT ?)",
+                (excess,)
+            )
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class CachedEmbeddings(Embeddings):
+    # Wraps an embeddings client so only texts missing from the cache reach the embedding API.
+    # Re-uploading a book, in the same chat or another one, embeds nothing.
+
+    def __init__(self, embeddings, cache, model, task_type):
+        self.embeddings = embeddings
+        self.cache = cache
+        self.model = model
+        self.task_type = task_type
+
+    def embed_documents(self, texts):
+        keys = [embedding_key(text, self.model, self.task_type) for text in texts]
+        cached = self.cache.get_many(keys)
+
+        # Embed each missing text once, even if it appears several times in the batch
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in cached and key not in missing:
+                missing[key] = text
+        if missing:
+            vectors = self.embeddings.embed_documents(list(missing.values()))
+            fresh = dict(zip(missing.keys(), vectors))
+            self.cache.put_many(fresh)
+            cached.update(fresh)
+
+        return [cached[key] for key in keys]
+
+    def embed_query(self, text):
+        key = embedding_key(text, self.model, self.task_type)
+        cached = self.cache.get_many([key])
+        if key in cached:
+            return cached[key]
+        vector = self.embeddings.embed_query(text)
+        self.cache.put_many({key: vector})
+        return vector
@@ -1,9 +1,10 @@
+import argparse
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox
 import pandas as pd
 
 class AnnotationTool:
-    def __init__(self, root, file_path):
+    def __init__(self, root, file_path, review_below=None):
         self.root = root
         self.root.title("Model Response Annotation Tool")
         
@@ -18,14 +19,38 @@ class AnnotationTool:
             root.destroy()
             return
         
-        # Annotation results storage
-        self.annotations = {model: [None] * len(self.df) for model in ['gemini_1.5_flash', 'gemini_2.0_flash', 'learnlm_1.5_flash']}
+        # Annotation results storage, starting from any labels already in the file (e.g. from autograde.py)
+        self.annotations = {}
+        for model in ['gemini_1.5_flash', 'gemini_2.0_flash', 'learnlm_1.5_flash']:
+            column = f'{model}_annotation'
+            existing = self.df[column] if column in self.df else pd.Series(None, index=self.df.index)
+            self.annotations[model] = [label if isinstance(label, str) else None for label in existing]
+
+        # Rows to go through: all of them, or with review_below only those where some model's
+        # label has a lower confidence
+        self.rows = list(range(len(self.df)))
+        if review_below is not None:
+            self.rows = [i for i in self.rows if self.needs_review(i, review_below)]
+            if not self.rows:
+                messagebox.showinfo("Nothing to review", f"Every label has confidence {review_below} or more")
+                root.destroy()
+                return
+        self.reviewed = set()
         self.current_index = 0
 
         # UI setup
         self.setup_ui()
         self.load_sample()
     
+    def needs_review(self, i, review_below):
+        for model in self.annotations:
+            if self.annotations[model][i] is None:
+                return True
+            confidence = self.df.at[i, f'{model}_confidence'] if f'{model}_confidence' in self.df else None
+            if pd.notna(confidence) and confidence < review_below:
+                return True
+        return False
+
     def setup_ui(self):
         # Frame for navigation
         self.nav_frame = tk.Frame(self.root)
@@ -91,7 +116,7 @@ class AnnotationTool:
         self.clear_text_widgets()
         
         # Load data for current index
-        row = self.df.iloc[self.current_index]
+        row = self.df.iloc[self.rows[self.current_index]]
 
         # Display question
         self.question_text.config(state=tk.NORMAL)
@@ -114,8 +139,8 @@ class AnnotationTool:
         
         # Load existing annotations if available
         for model in self.annotation_vars:
-            if self.annotations[model][self.current_index] is not None:
-                self.annotation_vars[model].set(self.annotations[model][self.current_index])
+            if self.annotations[model][self.rows[self.current_index]] is not None:
+                self.annotation_vars[model].set(self.annotations[model][self.rows[self.current_index]])
             else:
                 self.annotation_vars[model].set("")
         
@@ -133,11 +158,13 @@ class AnnotationTool:
             text_box.config(state=tk.DISABLED)
         
     def save_current_annotation(self):
+        row = self.rows[self.current_index]
         for model in self.annotation_vars:
-            self.annotations[model][self.current_index] = self.annotation_vars[model].get()
+            self.annotations[model][row] = self.annotation_vars[model].get() or None
+        self.reviewed.add(row)
         
     def next_sample(self):
-        if self.current_index < len(self.df) - 1:
+        if self.current_index < len(self.rows) - 1:
             self.save_current_annotation()
             self.current_index += 1
             self.load_sample()
@@ -152,6 +179,10 @@ class AnnotationTool:
         self.save_current_annotation()
         for model in self.annotations:
             self.df[f'{model}_annotation'] = self.annotations[model]
+            # Reviewed labels count as hand labels, which autograde.py leaves alone
+            if f'{model}_confidence' in self.df:
+                for row in self.reviewed:
+                    self.df.at[row, f'{model}_confidence'] = 1.0
         save_path = filedialog.asksaveasfilename(defaultextension=".csv", filetypes=[("CSV files", "*.csv")])
         if save_path:
             self.df.to_csv(save_path, index=False)
@@ -159,14 +190,18 @@ class AnnotationTool:
     
     def update_progress_bar(self):
         # Calculate progress percentage
-        total = len(self.df)
+        total = len(self.rows)
         progress = (self.current_index + 1) / total * 100
         self.progress_bar["value"] = progress
         self.progress_label.config(text=f"Progress: {int(progress)}%")
 
 if __name__ == "__main__":
-    # file_path = 'harry-potter-trivia-ai-100-results.csv'
-    file_path = 'harry-potter-trivia-ai-100-results-clustering.csv'
+    parser = argparse.ArgumentParser(description="Label model answers by hand")
+    # 'harry-potter-trivia-ai-100-results.csv' for the default embedding
+    parser.add_argument("file_path", nargs="?", default='harry-potter-trivia-ai-100-results-clustering.csv')
+    parser.add_argument("--review-below", type=float,
+                        help="only show rows where a label from autograde.py has a lower confidence")
+    args = parser.parse_args()
     root = tk.Tk()
-    app = AnnotationTool(root, file_path)
+    app = AnnotationTool(root, args.file_path, args.review_below)
     root.mainloop()
\ No newline at end of file
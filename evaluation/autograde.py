@@ -0,0 +1,187 @@
+# Pre-fills the <model>_annotation columns annot.py produces, with a <model>_confidence next to each.
+#
+#   python autograde.py harry-potter-trivia-ai-100-results-clustering.csv   # grade in place
+#   python autograde.py results.csv --embeddings                            # also compare embeddings
+#   python autograde.py --check                                             # agreement with the hand labels
+#   python annot.py results.csv --review-below 0.7                          # review only the unsure rows
+#
+# Each answer is compared with the reference in the answer column: the share of its content words
+# the response contains, the best fuzzy match of the reference against a stretch of the response,
+# and refusals ("The text does not mention ...") which are always Incorrect. Long references are
+# usually paraphrased, so they get a low confidence whatever the overlap. With --embeddings the
+# cosine similarity of the Gemini embeddings rescues paraphrased answers the word overlap misses.
+# Hand labels already in the file are kept (confidence 1) unless --overwrite is given.
+import argparse
+import difflib
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+MODELS = ['gemini_1.5_flash', 'gemini_2.0_flash', 'learnlm_1.5_flash']
+LABELS = ["Correct", "Partially Correct", "Incorrect"]
+CHECK_FILES = ["annotated-results.csv", "clustering-annotations.csv"]
+
+STOPWORDS = set(
+    "a an the of to in on at for and or is was were be by with as it its his her their he she they "
+    "that this from which who what".split()
+)
+# The model said it couldn't answer, or the pipeline failed
+REFUSAL = (
+    r"\b(?:does not|doesn't|do not|don't|did not|didn't|cannot|can't|unable to)\b[^.]*"
+    r"\b(?:mention|state|say|specify|provide|contain|describe|include|name|know|determine|answer)"
+    r"|\bnot (?:mentioned|provided|stated|specified|named)\b"
+    r"|\bno (?:specific |information|\w+ (?:is|are) (?:mentioned|named|given))"
+    r"|^error\b"
+)
+
+CORRECT_OVERLAP = 0.5  # share of the reference's content words
+FUZZY_MATCH = 0.8  # difflib ratio of the reference against its best-matching stretch of the response
+PARTIAL_FUZZY = 0.6
+LONG_ANSWER = 6  # content words; longer references are judged on meaning, not wording
+EMBEDDING_PARTIAL = 0.8  # cosine similarity that lifts an Incorrect to Partially Correct
+EMBEDDING_UNRELATED = 0.6
+
+
+def normalize(texts):
+    # Lowercase, drop possessives and punctuation, collapse whitespace
+    return (texts.fillna("").astype(str).str.lower()
+            .str.replace(r"[’']s\b", "", regex=True)
+            .str.replace(r"[^\w\s]", " ", regex=True)
+            .str.split().str.join(" "))
+
+
+def content_tokens(normalized):
+    # Sets of words without stopwords, with a crude plural strip so "wands" matches "wand"
+    return normalized.str.split().apply(
+        lambda words: {w[:-1] if len(w) > 3 and w.endswith("s") else w for w in words if w not in STOPWORDS}
+    )
+
+
+def token_recall(references, responses):
+    return pd.Series([len(ref & resp) / len(ref) if ref else 0.0 for ref, resp in zip(references, responses)],
+                     index=references.index)
+
+
+def partial_ratio(reference, response):
+    # Best similarity between the reference and an equally long stretch of the response
+    if not reference or not response:
+        return 0.0
+    if reference in response:
+        return 1.0
+    best = 0.0
+    for block in difflib.SequenceMatcher(None, reference, response, autojunk=False).get_matching_blocks():
+        start = max(block.b - block.a, 0)
+        window = response[start:start + len(reference)]
+        best = max(best, difflib.SequenceMatcher(None, reference, window).ratio())
+    return best
+
+
+def embedding_similarity(references, responses):
+    # Cosine similarity of each pair, embedding every distinct text once
+    import functions
+
+    texts = sorted(set(references) | set(responses))
+    vectors = np.array(functions.embeddings.get().embed_documents(texts))
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    position = {text: i for i, text in enumerate(texts)}
+    left = vectors[[position[text] for text in references]]
+    right = vectors[[position[text] for text in responses]]
+    return pd.Series((left * right).sum(axis=1), index=references.index)
+
+
+def grade(df, models=MODELS, use_embeddings=False):
+    # Returns {model: DataFrame of label, confidence and the scores behind them}
+    references = normalize(df['answer'])
+    reference_tokens = content_tokens(references)
+    length = reference_tokens.str.len()
+    grades = {}
+    for model in models:
+        responses = normalize(df[model])
+        recall = token_recall(reference_tokens, content_tokens(responses))
+        fuzzy = pd.Series([partial_ratio(ref, resp) for ref, resp in zip(references, responses)], index=df.index)
+        refusal = df[model].fillna("").astype(str).str.strip().str.contains(REFUSAL, case=False, regex=True)
+        score = np.maximum(recall, fuzzy.where(fuzzy >= FUZZY_MATCH, 0.0))
+
+        label = pd.Series(np.select(
+            [refusal, score >= CORRECT_OVERLAP, (score > 0) | (fuzzy >= PARTIAL_FUZZY)],
+            ["Incorrect", "Correct", "Partially Correct"], "Incorrect"), index=df.index)
+        confidence = pd.Series(np.select(
+            [refusal, (score >= 0.99) & (length <= LONG_ANSWER - 1), length > LONG_ANSWER,
+             score >= CORRECT_OVERLAP, score > 0],
+            [0.8, 0.95, 0.4, 0.75, 0.5], 0.6), index=df.index)
+        result = pd.DataFrame({"label": label, "confidence": confidence, "recall": recall, "fuzzy": fuzzy})
+
+        if use_embeddings:
+            similarity = embedding_similarity(df['answer'].fillna("").astype(str), df[model].fillna("").astype(str))
+            unanswered = (label == "Incorrect") & ~refusal
+            result.loc[unanswered & (similarity >= EMBEDDING_PARTIAL), ["label", "confidence"]] = ["Partially Correct", 0.5]
+            result.loc[unanswered & (similarity < EMBEDDING_UNRELATED), "confidence"] = 0.75
+            result["similarity"] = similarity
+        grades[model] = result
+    return grades
+
+
+def fill(df, grades, overwrite=False):
+    # Writes the labels into df, keeping hand labels unless overwrite. A hand label is one
+    # without a confidence, or confidence 1 as annot.py saves it.
+    for model, result in grades.items():
+        column = f'{model}_annotation'
+        existing = df[column] if column in df and not overwrite else pd.Series(np.nan, index=df.index)
+        previous = df.get(f'{model}_confidence', pd.Series(np.nan, index=df.index))
+        labelled = existing.isin(LABELS) & (previous.isna() | (previous >= 1))
+        df[column] = existing.where(labelled, result["label"])
+        df[f'{model}_confidence'] = result["confidence"].where(~labelled, 1.0).round(2)
+    return df
+
+
+def check(paths, models, threshold, use_embeddings):
+    # Grades hand-labelled files as if unlabelled and compares
+    for path in paths:
+        df = pd.read_csv(path)
+        grades = grade(df, models, use_embeddings)
+        print(os.path.basename(path))
+        for model in models:
+            human, result = df[f'{model}_annotation'], grades[model]
+            agree = result["label"] == human
+            sure = result["confidence"] >= threshold
+            print(f"  {model}: {agree.mean():.0%} agreement, {agree[sure].mean():.0%} on the {sure.mean():.0%} "
+                  f"of rows with confidence >= {threshold}")
+            matrix = pd.crosstab(human.rename("human"), result["label"].rename("auto")).reindex(
+                index=LABELS, columns=LABELS, fill_value=0)
+            print("    " + matrix.to_string().replace("\n", "\n    "))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Auto-grade model answers against the reference answers")
+    parser.add_argument("input", nargs="?", help="results CSV to grade")
+    parser.add_argument("--output", help="defaults to the input, so annot.py can open it")
+    parser.add_argument("--models", nargs="+", default=MODELS)
+    parser.add_argument("--embeddings", action="store_true", help="also compare Gemini embeddings (needs GEMINI_API_KEY)")
+    parser.add_argument("--overwrite", action="store_true", help="regrade rows that already have a label")
+    parser.add_argument("--check", action="store_true", help="report agreement with the hand-labelled files")
+    parser.add_argument("--threshold", type=float, default=0.7, help="confidence counted as sure in the report")
+    args = parser.parse_args()
+
+    if args.embeddings:
+        sys.path.insert(0, os.path.dirname(HERE))
+    if args.check:
+        check([os.path.join(HERE, name) for name in CHECK_FILES], args.models, args.threshold, args.embeddings)
+    if not args.input:
+        if not args.check:
+            parser.error("give a CSV to grade or --check")
+        return
+
+    df = pd.read_csv(args.input)
+    fill(df, grade(df, args.models, args.embeddings), args.overwrite)
+    output = args.output or args.input
+    df.to_csv(output, index=False)
+    unsure = pd.concat([df[f'{model}_confidence'] < args.threshold for model in args.models], axis=1).any(axis=1)
+    print(f"Wrote {output}; {unsure.sum()} of {len(df)} rows have an answer with confidence below {args.threshold}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,261 @@
+# Runs the trivia questions through every model with the RAG context from eval.ipynb, concurrently.
+#
+#   python run_eval.py                                   # all questions x the three notebook models
+#   python run_eval.py --limit 10 --concurrency 4        # quick check
+#   python run_eval.py --models gemini_2.0_flash=models/gemini-2.0-flash-exp
+#   python run_eval.py --rpm 15                          # stay under a per-model quota
+#
+# Results go to a new <input>-results-<timestamp>.csv, so the committed results are never
+# overwritten; an existing --output is only replaced with --force. Every answer is appended to
+# a JSONL checkpoint (by default <input>-results.checkpoint.jsonl) as soon as it arrives;
+# re-running the same command skips what is already there, so an interrupted run just resumes.
+# Web results come straight from the search provider behind the eval's own limiter, which waits
+# for a slot instead of dropping the search like the bot's. Answers are also
+# cached across runs by (model, prompt hash), so re-running with a new model only calls that
+# model. The output CSV keeps the columns annot.py reads (question, answer, one per model) and
+# adds <model>_latency_s, <model>_prompt_tokens and <model>_output_tokens. Latencies of cached
+# answers are the ones measured when they were generated.
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import pandas as pd
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from web_search import TokenBucket  # noqa: E402
+
+DEFAULT_MODELS = {
+    "gemini_1.5_flash": "models/gemini-1.5-flash-8b-latest",
+    "gemini_2.0_flash": "models/gemini-2.0-flash-exp",
+    "learnlm_1.5_flash": "models/learnlm-1.5-pro-experimental",
+}
+# Use "eval-default" for the default embedding and "eval-clustering" for clustered embeddings
+DEFAULT_CHAT_ID = "eval-clustering"
+MAX_ATTEMPTS = 6
+
+template = """Answer as briefly as you can to the folowing question using the provided Context and Web Results. 
+You are required to give a one-shot answer.
+
+<Web Results>{web_results}</Web Results>
+<Context>{context}</Context>
+<Question>{question}</Question>
+
+"""
+
+
+def prompt_hash(prompt):
+    return hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    # (model, prompt hash) -> answer, token counts and the latency it was generated in
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " model TEXT, prompt_hash TEXT, answer TEXT, latency_s REAL, prompt_tokens INTEGER,"
+            " output_tokens INTEGER, PRIMARY KEY (model, prompt_hash))"
+        )
+        self._conn.commit()
+
+    def get(self, model, key):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT answer, latency_s, prompt_tokens, output_tokens FROM responses WHERE model = ? AND prompt_hash = ?",
+                (model, key)
+            ).fetchone()
+        if row is None:
+            return None
+        return dict(zip(("answer", "latency_s", "prompt_tokens", "output_tokens"), row))
+
+    def put(self, model, key, result):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                (model, key, result["answer"], result["latency_s"], result["prompt_tokens"], result["output_tokens"])
+            )
+            self._conn.commit()
+
+
+class Checkpoint:
+    # Append-only JSONL of finished (question, model) results
+    def __init__(self, path):
+        self.path = path
+        self.done = {}
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # a line cut short by the interruption
+                    self.done[(record["index"], record["column"])] = record
+        self._lock = threading.Lock()
+        self._file = open(path, "a", encoding="utf-8")
+
+    def write(self, record):
+        with self._lock:
+            self._file.write(json.dumps(record) + "\n")
+            self._file.flush()
+            self.done[(record["index"], record["column"])] = record
+
+    def close(self):
+        self._file.close()
+
+
+def with_retries(fn, *args):
+    # Exponential backoff like the notebook's tenacity decorator, for quota errors and timeouts
+    for attempt in range(MAX_ATTEMPTS):
+        try:
+            return fn(*args)
+        except Exception:
+            if attempt == MAX_ATTEMPTS - 1:
+                raise
+            time.sleep(min(2 ** attempt, 60))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate models on the trivia questions, concurrently and resumably")
+    parser.add_argument("--input", default=os.path.join(HERE, "harry-potter-trivia-ai-100.csv"))
+    parser.add_argument("--output", help="defaults to a new <input>-results-<timestamp>.csv")
+    parser.add_argument("--force", action="store_true", help="overwrite --output if it exists")
+    parser.add_argument("--checkpoint", help="defaults to <input>-results.checkpoint.jsonl")
+    parser.add_argument("--cache", default=os.path.join(HERE, "eval_cache.sqlite3"))
+    parser.add_argument("--models", nargs="+", metavar="COLUMN=MODEL_ID",
+                        help="output column and Gemini model id pairs (default: the three notebook models)")
+    parser.add_argument("--chat-id", default=DEFAULT_CHAT_ID, help="vector store holding the book")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--rpm", type=float, default=60, help="requests per minute per model")
+    parser.add_argument("--no-web", action="store_true", help="leave the web results empty")
+    parser.add_argument("--web-rpm", type=float, default=60, help="web searches per minute")
+    parser.add_argument("--limit", type=int, help="only the first N questions")
+    args = parser.parse_args()
+
+    models = dict(pair.split("=", 1) for pair in args.models) if args.models else DEFAULT_MODELS
+    stem = os.path.splitext(args.input)[0]
+    output = args.output or f"{stem}-results-{time.strftime('%Y%m%d-%H%M%S')}.csv"
+    if os.path.exists(output) and not args.force:
+        parser.error(f"{output} exists; pass --force to overwrite it")
+    checkpoint_path = args.checkpoint or f"{stem}-results.checkpoint.jsonl"
+
+    import google.generativeai as genai
+    import functions
+
+    genai.configure(api_key=functions.GOOGLE_API_KEY)
+    llms = {
+        column: genai.GenerativeModel(model_id, generation_config={"temperature": 0, "response_mime_type": "text/plain"})
+        for column, model_id in models.items()
+    }
+    limiters = {column: TokenBucket(args.rpm / 60, 1) for column in models}
+    web_limiter = TokenBucket(args.web_rpm / 60, 1)
+
+    def search_web(question):
+        # The provider behind functions.get_web_results, without the bot's limiter that gives up
+        # after half a second: here every question waits its turn for a web search
+        web_limiter.acquire(timeout=float("inf"))
+        return functions.web_search.provider.search(question) or ""
+
+    df = pd.read_csv(args.input)
+    if args.limit:
+        df = df.head(args.limit)
+    cache = ResponseCache(args.cache)
+    checkpoint = Checkpoint(checkpoint_path)
+    retriever = functions.get_retriever(args.chat_id)
+
+    # The prompt only depends on the question, so retrieval and web search run once per question
+    prompts, prompt_lock = {}, threading.Lock()
+
+    def build_prompt(index):
+        with prompt_lock:
+            event = prompts.get(index)
+            if event is None:
+                event = prompts[index] = [threading.Event(), None]
+                owner = True
+            else:
+                owner = False
+        if owner:
+            question = df.at[index, "question"]
+            try:
+                docs = with_retries(retriever.invoke, question)
+                web_results = "" if args.no_web else with_retries(search_web, question)
+                event[1] = template.format(context=functions.format_docs(docs[:30]), question=question,
+                                           web_results=web_results)
+            finally:
+                event[0].set()
+        event[0].wait()
+        if event[1] is None:
+            raise RuntimeError("could not build the prompt")
+        return event[1]
+
+    def generate(column, prompt):
+        limiters[column].acquire(timeout=float("inf"))
+        start = time.perf_counter()
+        response = llms[column].generate_content(prompt)
+        latency = time.perf_counter() - start
+        usage = getattr(response, "usage_metadata", None)
+        return {
+            "answer": response.text,
+            "latency_s": round(latency, 3),
+            "prompt_tokens": getattr(usage, "prompt_token_count", None),
+            "output_tokens": getattr(usage, "candidates_token_count", None),
+        }
+
+    def run(index, column):
+        prompt = build_prompt(index)
+        key = prompt_hash(prompt)
+        result = cache.get(models[column], key)
+        if result is None:
+            result = with_retries(generate, column, prompt)
+            cache.put(models[column], key, result)
+        checkpoint.write({"index": int(index), "column": column, "prompt_hash": key, **result})
+
+    tasks = [(index, column) for index in df.index for column in models if (int(index), column) not in checkpoint.done]
+    print(f"{len(tasks)} answers to generate, {len(df) * len(models) - len(tasks)} already in {checkpoint_path}")
+    errors = {}
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        futures = {pool.submit(run, index, column): (index, column) for index, column in tasks}
+        for done, future in enumerate(as_completed(futures), 1):
+            if future.exception() is not None:
+                errors[futures[future]] = future.exception()
+            if done % 10 == 0 or done == len(futures):
+                print(f"{done}/{len(futures)} done, {len(errors)} errors, {time.perf_counter() - started:.0f}s")
+    checkpoint.close()
+
+    for column in models:
+        for suffix in ("", "_latency_s", "_prompt_tokens", "_output_tokens"):
+            df[column + suffix] = None
+    for index in df.index:
+        for column in models:
+            record = checkpoint.done.get((int(index), column))
+            if record:
+                df.at[index, column] = record["answer"].replace("\n", " ")
+                df.at[index, column + "_latency_s"] = record["latency_s"]
+                df.at[index, column + "_prompt_tokens"] = record["prompt_tokens"]
+                df.at[index, column + "_output_tokens"] = record["output_tokens"]
+            elif (index, column) in errors:
+                df.at[index, column] = f"Error: {errors[(index, column)]}"
+    df.to_csv(output, index=False)
+
+    print(f"Wrote {output}")
+    for column in models:
+        latencies = pd.to_numeric(df[column + "_latency_s"], errors="coerce").dropna()
+        tokens = pd.to_numeric(df[column + "_output_tokens"], errors="coerce").dropna()
+        if len(latencies):
+            summary = f"{column}: p50 {latencies.median():.2f}s, p95 {latencies.quantile(0.95):.2f}s"
+            if len(tokens):
+                summary += f", {tokens.mean():.0f} output tokens on average"
+            print(summary)
+
+
+if __name__ == "__main__":
+    main()
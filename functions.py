@@ -1,26 +1,29 @@
 import hashlib
 import os
-from langchain_community.document_loaders import PyMuPDFLoader
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_google_genai import GoogleGenerativeAIEmbeddings
-from pymongo import MongoClient
-from langchain_pinecone import PineconeVectorStore
-from pinecone import Pinecone, ServerlessSpec
-
-# rag chain imports
-from langchain.prompts import PromptTemplate
-from langchain_core.runnables import RunnableLambda
-from langchain.schema.runnable import RunnablePassthrough
-from langchain.schema.output_parser import StrOutputParser
+from collections import deque
+import threading
+import time
+from concurrent.futures import ALL_COMPLETED, FIRST_COMPLETED, ThreadPoolExecutor, TimeoutError as FutureTimeoutError, wait
+
 from dotenv import load_dotenv
 
 from datetime import datetime, timezone
 
-import google.generativeai as genai
-from google.generativeai.types import HarmCategory, HarmBlockThreshold
-
 import json
-from duckduckgo_search import DDGS
+
+# Gemini, Pinecone, Mongo, the document loaders and the langchain_core subclasses (embedding cache,
+# local vector store, hybrid retriever) are imported by the factories and functions that use them
+# (see clients.py), so importing this module is cheap and never touches the network
+import metrics
+from caching import LRUCache
+from clients import LazyClient, Limited, upstream, warm_up as warm_up_clients
+from history_buffer import HistoryWriteBuffer, message_key
+from history_summary import HISTORY_SUMMARY, HISTORY_SUMMARY_WORDS, HistorySummarizer, unsummarized
+from keyword_index import KeywordIndex, keyword_coverage
+from persona import detect_persona
+from prompt_builder import SUMMARY_LABEL, build_prompt
+from response_cache import SemanticCache, history_dependent
+from web_search import DDGProvider, FakeProvider, WebSearch
 
 load_dotenv()
 
@@ -29,52 +32,98 @@ MONGO_DB_URI = os.environ.get('MONGO_DB_URI')
 GOOGLE_API_KEY = os.environ.get('GEMINI_API_KEY')
 MONGO_DB_HISTORY = os.environ.get('MONGO_DB_HISTORY')
 
-genai.configure(api_key=GOOGLE_API_KEY)
-llm = genai.GenerativeModel("models/gemini-1.5-flash-8b-latest",
-                            system_instruction="""
-                            You are a chatbot designed to answer in the style of a character from a book within a messaging app. 
-                            If the character is provided to you, answer as them, otherwise you are a chatbot named Portal-LLM. 
-                            Talk like a normal person if no character is provided to you.
-                            """,
-                            generation_config={
-                                "response_mime_type": "text/plain"}
-                            )
-
-classifier = genai.GenerativeModel("gemini-1.5-flash-8b-latest",
+WARM_UP_TIMEOUT = float(os.environ.get('WARM_UP_TIMEOUT', 10))
+
+
+def create_llm():
+    import google.generativeai as genai
+    genai.configure(api_key=GOOGLE_API_KEY)
+    return genai.GenerativeModel("models/gemini-1.5-flash-8b-latest",
+                                 system_instruction="""
+                                 You are a chatbot designed to answer in the style of a character from a book within a messaging app. 
+                                 If the character is provided to you, answer as them, otherwise you are a chatbot named Portal-LLM. 
+                                 Talk like a normal person if no character is provided to you.
+                                 """,
+                                 generation_config={
+                                     "response_mime_type": "text/plain"}
+                                 )
+
+
+def create_classifier():
+    import google.generativeai as genai
+    genai.configure(api_key=GOOGLE_API_KEY)
+    return genai.GenerativeModel("gemini-1.5-flash-8b-latest",
                                 #    system_instruction="You are a classifier whose job is to extract the subject of a sentence, if there is one.",
-                                   generation_config={"response_mime_type": "application/json"})
+                                 generation_config={"response_mime_type": "application/json"})
+
+
+def create_summarizer():
+    import google.generativeai as genai
+    genai.configure(api_key=GOOGLE_API_KEY)
+    return genai.GenerativeModel("models/gemini-1.5-flash-8b-latest",
+                                 generation_config={"temperature": 0, "response_mime_type": "text/plain"})
+
+
+def create_mongo_client():
+    from pymongo import MongoClient
+    return MongoClient(MONGO_DB_URI)
+
+
+llm = LazyClient("llm", create_llm)
+classifier = LazyClient("classifier", create_classifier)
+summarizer = LazyClient("summarizer", create_summarizer)
+mongo = LazyClient("mongo", create_mongo_client)
 
-# Connect to MongoDB
-client = MongoClient(MONGO_DB_URI)
-db = client['langchain-db']
-history_db = db['history']
-characters_db = db['character']
+
+def collection(name):
+    return mongo.get()['langchain-db'][name]
+
+
+# Each chat's current character, so the common "no new character" path skips Mongo. Only the
+# process that handles a switch updates its cache, so under several gunicorn workers the others
+# see the new character once their entry expires; keep the TTL short.
+CHARACTER_CACHE_TTL = float(os.environ.get('CHARACTER_CACHE_TTL', 5))
+CHARACTER_CACHE_CHATS = int(os.environ.get('CHARACTER_CACHE_CHATS', 1000))
+character_cache = LRUCache("characters", maxsize=CHARACTER_CACHE_CHATS, ttl=CHARACTER_CACHE_TTL)
+# The last character this process saw for each chat, without expiry: the fallback when the
+# lookup fails or times out
+last_known_characters = LRUCache("last_known_characters", maxsize=CHARACTER_CACHE_CHATS)
+
+
+def remember_character(chat_id, character):
+    character_cache.set(chat_id, character)
+    last_known_characters.set(chat_id, character)
 
 
 def handle_character_request(chat_id, query):
     # Step 1: Classify the query
     classification = classify(query)
 
-    print("Classification", classification)
-
     if (classification == None) or (classification and "none" in classification.lower()):
-        character = characters_db.find_one({'chat_id': chat_id})
-
-        if character and 'last_character' in character:
-            return character['last_character']
-        else:
-            return ""
+        cached = character_cache.get(chat_id)
+        if cached is not None:
+            return cached
+
+        character = collection('character').find_one({'chat_id': chat_id})
+        last_character = character['last_character'] if character and 'last_character' in character else ""
+        remember_character(chat_id, last_character)
+        return last_character
     else:
-        characters_db.update_one(
+        collection('character').update_one(
             {'chat_id': chat_id},
             {'$set': {'last_character': classification}},
             upsert=True
         )
+        remember_character(chat_id, classification)
         return classification
 
 
-# Initialize Pinecone
-pinecone = Pinecone(api_key=os.environ.get("PINECONE_API_KEY"))
+def create_pinecone():
+    from pinecone import Pinecone
+    return Pinecone(api_key=os.environ.get("PINECONE_API_KEY"))
+
+
+pinecone = LazyClient("pinecone", create_pinecone)
 
 # Add 'Answer like'
 template = """
@@ -89,29 +138,31 @@ Think step by step before producing a response.
 
 """
 
-custom_rag_prompt = PromptTemplate(
-    template=template,
-    input_variables=["context", "question", "web_results", "chat_history", "character"]
-)
+# Filled with str.format by build_prompt; the same result PromptTemplate gives, without importing langchain's prompt machinery
+custom_rag_prompt = template
 
 
 def format_docs(docs):
     return "\n\n".join([d.page_content for d in docs])
 
 
-def get_web_results(query):
-    print("Searching the web for", query)
-    try:
-        results = DDGS().chat(query)  # , model='claude-3-haiku')
-    except:
-        results = DDGS().answers(query)
+# "ddg" searches DuckDuckGo; "none" turns web results off
+WEB_SEARCH_PROVIDER = os.environ.get('WEB_SEARCH_PROVIDER', 'ddg')
+web_search = WebSearch(DDGProvider() if WEB_SEARCH_PROVIDER == 'ddg' else FakeProvider())
+
 
-    # print("The results are", results)
-    return results
+def get_web_results(query):
+    return web_search.search(query)
 
 
 def classify(query):
-    print("Attempting to classify:", query)
+    # Settle clear cases locally and only ask the LLM about ambiguous messages
+    decision, character = detect_persona(query)
+    if decision == "set":
+        return character
+    if decision == "none":
+        return "None"
+
     try:
         prompt = f"""
         Rules:
@@ -129,43 +180,139 @@ def classify(query):
 
         """
 
-        print(prompt)
-        print(classifier.generate_content(prompt).text)
-
         # answer = json.loads(classifier.generate_content(prompt).text)
         # answer =  str(next(iter(answer.values())))
-        
-        answer = classifier.generate_content(prompt).text
+
+        with upstream("gemini"):
+            answer = classifier.get().generate_content(prompt).text
         return answer
     except:
         pass
 
 
-def initialize_vector_store(chat_id):
-    try:
-        pinecone.create_index(
-            name=str(chat_id),
-            dimension=768,
-            metric="cosine",
-            spec=ServerlessSpec(
-                cloud="aws",
-                region="us-east-1")
-        )
-    except:
-        pass
-    pinecone_index = pinecone.Index(str(chat_id))
+# Process-wide caches for the vector store path, so a message doesn't rebuild clients or
+# re-issue create_index for a chat that is already set up
+VECTOR_STORE_CACHE_SIZE = int(os.environ.get('VECTOR_STORE_CACHE_SIZE', 256))
+VECTOR_STORE_CACHE_TTL = float(os.environ.get('VECTOR_STORE_CACHE_TTL', 3600))
+vector_store_cache = LRUCache("vector_store", maxsize=VECTOR_STORE_CACHE_SIZE, ttl=VECTOR_STORE_CACHE_TTL)
+known_indexes = set()
+index_lock = threading.Lock()
+
+# "per_chat" keeps one Pinecone index per chat; "shared" stores every chat in one index,
+# isolated by namespace, which avoids account index limits and index cold starts for new chats
+PINECONE_INDEX_MODE = os.environ.get('PINECONE_INDEX_MODE', 'per_chat')
+PINECONE_SHARED_INDEX = os.environ.get('PINECONE_SHARED_INDEX', 'portal-llm')
+
+# "pinecone" or "local"; the local backend keeps each chat's vectors on disk under LOCAL_VECTOR_DIR
+VECTOR_BACKEND = os.environ.get('VECTOR_BACKEND', 'pinecone')
+LOCAL_VECTOR_DIR = os.environ.get('LOCAL_VECTOR_DIR', 'vector_data')
 
-    vector_store = PineconeVectorStore(
-        index=pinecone_index,
-        embedding=GoogleGenerativeAIEmbeddings(
+# One embeddings client shared by every chat, behind a content-addressed cache so
+# chunks that were embedded before (same book, any chat) never reach the API again
+EMBEDDING_MODEL = "models/text-embedding-004"
+EMBEDDING_TASK_TYPE = "clustering"
+
+
+def create_embeddings():
+    from langchain_google_genai import GoogleGenerativeAIEmbeddings
+    from embedding_cache import CachedEmbeddings, EmbeddingCache
+    return CachedEmbeddings(
+        Limited(GoogleGenerativeAIEmbeddings(
             google_api_key=GOOGLE_API_KEY,
-            model="models/text-embedding-004",
-            task_type="clustering"
+            model=EMBEDDING_MODEL,
+            task_type=EMBEDDING_TASK_TYPE
+        ), "gemini", ["embed_documents", "embed_query"]),
+        EmbeddingCache(),
+        model=EMBEDDING_MODEL,
+        task_type=EMBEDDING_TASK_TYPE
+    )
+
+
+embeddings = LazyClient("embeddings", create_embeddings)
+
+# Hybrid retrieval: dense results fused with a local BM25 index of the same chunks, which finds the
+# exact spell names and proper nouns embeddings miss. Chunks ingested before it was enabled are only
+# found by the dense search until the book is uploaded again.
+HYBRID_RETRIEVAL = os.environ.get('HYBRID_RETRIEVAL', '1') == '1'
+RERANK = os.environ.get('RERANK', '0') == '1'
+RETRIEVAL_K = int(os.environ.get('RETRIEVAL_K', 5))
+KEYWORD_K = int(os.environ.get('KEYWORD_K', 10))
+# Skip the web search when a retrieved chunk contains at least this share of the query's terms (0 never skips).
+# The web search then waits for retrieval instead of running beside it.
+WEB_SKIP_COVERAGE = float(os.environ.get('WEB_SKIP_COVERAGE', 0))
+keyword_index = KeywordIndex() if HYBRID_RETRIEVAL else None
+
+
+def ensure_index(name):
+    if name in known_indexes:
+        return
+    with index_lock:
+        if name in known_indexes:
+            return
+        # Refresh from the control plane only when we see a name we don't know yet
+        from pinecone import ServerlessSpec
+        known_indexes.update(pinecone.get().list_indexes().names())
+        if name not in known_indexes:
+            try:
+                pinecone.get().create_index(
+                    name=name,
+                    dimension=embedding_dim,
+                    metric="cosine",
+                    spec=ServerlessSpec(
+                        cloud="aws",
+                        region="us-east-1")
+                )
+            except Exception as e:
+                metrics.log_error("create_index_failed", e, index=name)
+            known_indexes.add(name)
+
+
+def build_vector_store(chat_id):
+    if VECTOR_BACKEND == 'local':
+        from local_vector_store import LocalVectorStore
+        vector_store = LocalVectorStore(os.path.join(LOCAL_VECTOR_DIR, str(chat_id)), embeddings.get())
+    elif PINECONE_INDEX_MODE == 'shared':
+        from langchain_pinecone import PineconeVectorStore
+        ensure_index(PINECONE_SHARED_INDEX)
+        vector_store = PineconeVectorStore(
+            index=pinecone.get().Index(PINECONE_SHARED_INDEX),
+            embedding=embeddings.get(),
+            namespace=str(chat_id)
+        )
+    else:
+        from langchain_pinecone import PineconeVectorStore
+        ensure_index(str(chat_id))
+        vector_store = PineconeVectorStore(
+            index=pinecone.get().Index(str(chat_id)),
+            embedding=embeddings.get()
         )
+    retriever = vector_store.as_retriever(
+        search_type="similarity_score_threshold",
+        search_kwargs={"k": RETRIEVAL_K, "score_threshold": 0.5},
     )
+    if keyword_index:
+        from hybrid_retriever import HybridRetriever
+        retriever = HybridRetriever(
+            vector_retriever=retriever,
+            keyword_index=keyword_index,
+            chat_id=str(chat_id),
+            k=RETRIEVAL_K,
+            keyword_k=KEYWORD_K,
+            use_reranker=RERANK
+        )
+    return vector_store, retriever
+
+
+def initialize_vector_store(chat_id):
+    vector_store, _ = vector_store_cache.get_or_set(chat_id, lambda: build_vector_store(chat_id))
     return vector_store
 
 
+def get_retriever(chat_id):
+    _, retriever = vector_store_cache.get_or_set(chat_id, lambda: build_vector_store(chat_id))
+    return retriever
+
+
 def generate_file_hash(file_path):
     sha256 = hashlib.sha256()
     with open(file_path, "rb") as f:
@@ -174,99 +321,437 @@ def generate_file_hash(file_path):
     return sha256.hexdigest()
 
 
-def generate_response(query):
-    try:
-        response = llm.generate_content(query.text)
-        print(response.text)
-        return response.text
-    except Exception as e:
-        print("Something went wrong in generate_response")
-        return str(e)
+def generate_text(prompt, on_partial=None):
+    # Like generate_response, but raises so callers can tell an answer from an error.
+    # With on_partial the answer is streamed, and on_partial gets the text so far after every chunk.
+    with upstream("gemini"):
+        if on_partial is None:
+            return llm.get().generate_content(prompt).text
 
+        text = ""
+        for chunk in llm.get().generate_content(prompt, stream=True):
+            text += chunk.text
+            on_partial(text)
+        return text
 
-def chunk_and_store(file_path, chat_id):
-    try:
-        # Initialize Pinecone index and vector store
-        vector_store = initialize_vector_store(chat_id)
 
-        file_hash = generate_file_hash(file_path)
+def generate_response(prompt):
+    try:
+        return generate_text(prompt)
+    except Exception as e:
+        metrics.log_error("generate_failed", e, stage="generation")
+        return str(e)
 
-        # Load and split the document
-        loader = PyMuPDFLoader(file_path)
-        documents = loader.load()
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=1000, chunk_overlap=300)
-        chunks = text_splitter.split_documents(documents)
 
-        # Insert document chunks with unique IDs and file path metadata
-        uuids = [str(file_hash)+str(i) for i in range(len(chunks))]
+# Ingestion works page by page: chunks are embedded and upserted in batches of INGEST_BATCH_SIZE,
+# with at most INGEST_CONCURRENCY batches in flight, so memory stays flat regardless of book size
+INGEST_BATCH_SIZE = int(os.environ.get('INGEST_BATCH_SIZE', 64))
+INGEST_CONCURRENCY = int(os.environ.get('INGEST_CONCURRENCY', 4))
+# Minimum seconds between progress reports
+INGEST_PROGRESS_INTERVAL = float(os.environ.get('INGEST_PROGRESS_INTERVAL', 15))
 
-        vector_store.add_documents(documents=chunks, ids=uuids)
 
-        return "Documents successfully embedded and stored in Pinecone."
+def chunk_and_store(file_path, chat_id, progress=None):
+    try:
+        return ingest_document(file_path, chat_id, progress=progress)
     except Exception as e:
         # print("Exception thrown:", e)
         return str(e)
 
 
-def generate_response_with_rag(query, chat_id):
-    try:
-        vector_store = initialize_vector_store(chat_id)
-        retriever = vector_store.as_retriever(
-            search_type="similarity_score_threshold",
-            search_kwargs={"k": 5, "score_threshold": 0.5},
-        )
+# The set of files stored for each chat, hashed into one corpus id for the semantic cache key
+corpus_cache = LRUCache("corpus_hash", maxsize=int(os.environ.get('CORPUS_CACHE_CHATS', 1000)), ttl=600)
+
+
+def get_corpus_hash(chat_id):
+    def load():
+        corpus = collection('corpora').find_one({'chat_id': chat_id})
+        file_hashes = sorted(corpus.get('file_hashes', [])) if corpus else []
+        return hashlib.sha256(",".join(file_hashes).encode()).hexdigest()
+    return corpus_cache.get_or_set(chat_id, load)
+
+
+def record_corpus_file(chat_id, file_hash):
+    collection('corpora').update_one({'chat_id': chat_id}, {'$addToSet': {'file_hashes': file_hash}}, upsert=True)
+    corpus_cache.pop(chat_id)
+
+
+@metrics.timed("ingest")
+def ingest_document(file_path, chat_id, progress=None, file_hash=None):
+    # Same as chunk_and_store but raises on failure, so the job queue can retry.
+    # progress, if given, is called with a short status line at most every INGEST_PROGRESS_INTERVAL seconds
+
+    # Initialize the vector store for this chat
+    vector_store = initialize_vector_store(chat_id)
+
+    file_hash = file_hash or generate_file_hash(file_path)
+
+    from langchain_community.document_loaders import PyMuPDFLoader
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+    loader = PyMuPDFLoader(file_path)
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=1000, chunk_overlap=300)
+
+    started = time.perf_counter()
+    last_report = started
+    pages_done = chunks_done = chunk_count = 0
+    total_pages = None
+    batch, batch_ids = [], []
+    in_flight = set()
+    done_lock = threading.Lock()
+
+    def store(documents, ids):
+        with metrics.timer("ingest_batch"), upstream("pinecone"):
+            vector_store.add_documents(documents=documents, ids=ids)
+            if keyword_index:
+                keyword_index.add(chat_id, ids, documents)
+        return len(documents)
+
+    def count_stored(future):
+        # Runs as each batch finishes, so the progress line counts it without waiting for a drain
+        nonlocal chunks_done
+        if not future.cancelled() and future.exception() is None:
+            with done_lock:
+                chunks_done += future.result()
+
+    def submit(documents, ids):
+        future = pool.submit(store, documents, ids)
+        future.add_done_callback(count_stored)
+        in_flight.add(future)
+
+    def drain(return_when):
+        nonlocal in_flight
+        done, in_flight = wait(in_flight, return_when=return_when)
+        for future in done:
+            future.result()  # raises if the batch failed
+
+    with ThreadPoolExecutor(max_workers=INGEST_CONCURRENCY, thread_name_prefix="ingest") as pool:
+        for page in loader.lazy_load():
+            total_pages = page.metadata.get("total_pages", total_pages)
+            # Splitting page by page yields the same chunks, in the same order, as splitting the
+            # whole document, so chunk ids stay stable across re-uploads
+            for chunk in text_splitter.split_documents([page]):
+                batch.append(chunk)
+                batch_ids.append(str(file_hash) + str(chunk_count))
+                chunk_count += 1
+                if len(batch) >= INGEST_BATCH_SIZE:
+                    if len(in_flight) >= INGEST_CONCURRENCY:
+                        drain(FIRST_COMPLETED)
+                    submit(batch, batch_ids)
+                    batch, batch_ids = [], []
+            pages_done += 1
+
+            now = time.perf_counter()
+            if progress and now - last_report >= INGEST_PROGRESS_INTERVAL:
+                last_report = now
+                rate = chunks_done / (now - started)
+                progress(f"Processed {pages_done}/{total_pages or '?'} pages, "
+                         f"{chunks_done} chunks stored ({rate:.1f} chunks/s)")
+
+        if batch:
+            submit(batch, batch_ids)
+        drain(ALL_COMPLETED)
+    # Leaving the pool joins its threads, so every done callback has run and chunks_done is final
+
+    record_corpus_file(chat_id, file_hash)
+
+    elapsed = time.perf_counter() - started
+    return (f"Documents successfully embedded and stored in the vector store "
+            f"({chunks_done} chunks from {pages_done} pages in {elapsed:.0f}s).")
+
+
+# Shared pool for the per-message fan-out of retrieval, web search, history and character lookup
+FANOUT_WORKERS = int(os.environ.get('FANOUT_WORKERS', 16))
+fanout_pool = ThreadPoolExecutor(max_workers=FANOUT_WORKERS, thread_name_prefix="rag-fanout")
+
+# Seconds each source may take, measured from the start of the fan-out.
+# A source that times out or fails contributes an empty section instead of blocking the answer.
+SOURCE_TIMEOUTS = {
+    "classify": float(os.environ.get('CLASSIFY_TIMEOUT', 10)),
+    "history": float(os.environ.get('HISTORY_TIMEOUT', 3)),
+    "retrieval": float(os.environ.get('RETRIEVAL_TIMEOUT', 5)),
+    "web": float(os.environ.get('WEB_TIMEOUT', 8)),
+}
+SOURCE_TIMEOUTS["embed"] = SOURCE_TIMEOUTS["retrieval"]
+
+# Answers reused across users asking the same thing of the same character over the same books.
+# Standalone questions (see history_dependent) are answered without the chat's history in the
+# prompt, so the cached answer can't quote one user's conversation to another; follow-ups keep
+# their history and skip the cache.
+SEMANTIC_CACHE = os.environ.get('SEMANTIC_CACHE', '1') == '1'
+semantic_cache = SemanticCache() if SEMANTIC_CACHE else None
+
+
+def record_trace(trace):
+    # Every stage timing goes into the /metrics histograms. The trace itself is logged for a
+    # sample of requests, and always when a source degraded.
+    for stage, seconds in trace["timings"].items():
+        metrics.observe(stage, seconds)
+    for source in trace["degraded"]:
+        metrics.increment("degraded_total", source=source)
+    if trace.get("web_skipped"):
+        metrics.increment("web_skipped_total")
+    if trace.get("cancelled"):
+        metrics.increment("cancelled_total", before="generation")
+
+    if trace["degraded"] or metrics.sampled():
+        fields = {
+            "chat_id": trace["chat_id"],
+            "timings_ms": {stage: round(seconds * 1000) for stage, seconds in trace["timings"].items()},
+            "degraded": trace["degraded"],
+            "semantic_cache": trace.get("semantic_cache"),
+            "web_skipped": trace.get("web_skipped", False),
+            "cancelled": trace.get("cancelled", False),
+        }
+        if trace.get("prompt"):
+            fields["prompt_chars"] = len(trace["prompt"])
+            if metrics.LOG_PROMPTS:
+                fields["prompt"] = trace["prompt"]
+        metrics.log_event("rag_trace", **fields)
+
 
-        # print(vector_store)
+def wait_for_source(source, future, started, default, trace):
+    remaining = started + SOURCE_TIMEOUTS[source] - time.perf_counter()
+    try:
+        return future.result(timeout=max(remaining, 0))
+    except FutureTimeoutError:
+        future.cancel()
+    except Exception as e:
+        metrics.log_error("source_failed", e, source=source)
+    trace["degraded"].append(source)
+    return default
+
+
+def generate_response_with_rag(query, chat_id, on_partial=None, cancelled=None):
+    # on_partial, if given, streams the generation (see generate_text); the full answer is still returned.
+    # cancelled, if given, is checked before generating; when it returns True the answer is no longer
+    # wanted and None is returned without calling Gemini.
+    trace = {"chat_id": chat_id, "timings": {}, "degraded": [], "prompt": None}
+    request_started = time.perf_counter()
+
+    def timed(stage, fn, *args):
+        start = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            trace["timings"][stage] = time.perf_counter() - start
+
+    # Retrieval starts right away and its result is dropped on a semantic cache hit; it only skips
+    # the Pinecone query if the request has already returned. Web search already waits for the
+    # character, so it also waits for the cache check, which needs little more than that.
+    cache_checked = threading.Event()
+    finished = threading.Event()
+
+    def retrieve():
+        # Wait for the query embedding so the retriever's own embed_query is a cache hit
+        # instead of a second API call. It was submitted first, so it is never queued behind us.
+        try:
+            query_vector_future.result(timeout=SOURCE_TIMEOUTS["retrieval"])
+        except Exception:
+            pass  # the retriever embeds the query itself
+        if finished.is_set():
+            return []
+        with upstream("pinecone"):
+            return get_retriever(chat_id).invoke(query)
+
+    def search_web():
+        # The search term depends on the character, so wait for that lookup first.
+        # It was submitted before this task, so it is never queued behind us.
+        character = character_future.result(timeout=SOURCE_TIMEOUTS["classify"])
+        cache_checked.wait(SOURCE_TIMEOUTS["embed"])
+        if finished.is_set():
+            return ""
+        if WEB_SKIP_COVERAGE:
+            try:
+                docs = retrieval_future.result(timeout=SOURCE_TIMEOUTS["retrieval"])
+            except Exception:
+                docs = []
+            if any(keyword_coverage(query, doc.page_content) >= WEB_SKIP_COVERAGE for doc in docs):
+                trace["web_skipped"] = True
+                return ""
+        search_term = query if character in ("", "None") else character + " " + query
+        return get_web_results(search_term)
 
-        character = handle_character_request(chat_id, query)
-        print("character after mongodb", character)
+    try:
+        started = time.perf_counter()
+        use_cache = semantic_cache is not None and not history_dependent(query)
+        if not use_cache:
+            cache_checked.set()
+        character_future = fanout_pool.submit(timed, "classify", handle_character_request, chat_id, query)
+        query_vector_future = fanout_pool.submit(timed, "embed", embeddings.get().embed_query, query)
+        use_history = chat_id and not use_cache
+        history_future = fanout_pool.submit(timed, "history", get_chat_history, chat_id) if use_history else None
+        retrieval_future = fanout_pool.submit(timed, "retrieval", retrieve)
+        web_future = fanout_pool.submit(timed, "web", search_web)
+
+        # A failed lookup is not the same as no character: answer as the last one we know of
+        character = wait_for_source("classify", character_future, started, None, trace)
+        if character is None:
+            character = last_known_characters.get(chat_id)
+        if character is None:
+            return "Sorry, I couldn't look up who I'm playing right now. Please try again in a moment."
         if character == "":
             return "You haven't asked me to act like a character yet. Please choose one"
 
+        # Standalone questions to the same character over the same books are answered from the cache
+        cache_key = query_vector = None
+        if use_cache:
+            query_vector = wait_for_source("embed", query_vector_future, started, None, trace)
+            if query_vector is not None:
+                cache_key = (character, get_corpus_hash(chat_id))
+                cached_answer = semantic_cache.lookup(cache_key, query_vector)
+                trace["semantic_cache"] = "hit" if cached_answer else "miss"
+                if cached_answer:
+                    return cached_answer
+        cache_checked.set()
+
         # Get chat history with configurable size
-        chat_history = get_chat_history(chat_id) if chat_id else "No previous conversation."
-
-        search_term = query if character is "None" else character + " " + query
-
-        print(chat_history)
-
-        rag_chain = (
-            {"context": retriever | format_docs,
-             "question": RunnablePassthrough(), 
-             "web_results": RunnableLambda(lambda x: get_web_results(search_term)),
-             "chat_history": RunnableLambda(lambda _: chat_history),
-             "character": RunnableLambda(lambda _: character),
-             }
-            | custom_rag_prompt
-            | RunnableLambda(lambda x: generate_response(x))
-            # | StrOutputParser
-        )
+        if history_future:
+            chat_history = wait_for_source("history", history_future, started, "", trace)
+        else:
+            chat_history = "No previous conversation."
+        docs = wait_for_source("retrieval", retrieval_future, started, [], trace)
+        web_results = wait_for_source("web", web_future, started, "", trace)
+
+        # Each section is held to its token budget; overlapping chunks are merged and repeats dropped
+        prompt = build_prompt(custom_rag_prompt, query, character, docs, web_results, chat_history)
+        trace["prompt"] = prompt
+
+        if cancelled and cancelled():
+            trace["cancelled"] = True
+            return None
+
+        def partial(text):
+            trace["timings"].setdefault("first_token", time.perf_counter() - generation_started)
+            on_partial(text)
+
+        try:
+            generation_started = time.perf_counter()
+            answer = timed("generation", generate_text, prompt, partial if on_partial else None)
+        except Exception as e:
+            metrics.log_error("generate_failed", e, stage="generation", chat_id=chat_id)
+            return str(e)
+        if cache_key:
+            semantic_cache.store(cache_key, query_vector, answer)
+        return answer
 
-        prompt = custom_rag_prompt.format(
-            context = format_docs(retriever.invoke(query)[:30]),
-            question = query, 
-            web_results = get_web_results(query),
-            chat_history = chat_history,
-            character =  character,
-        )
+    except Exception as e:
+        metrics.log_error("rag_failed", e, stage="rag", chat_id=chat_id)
+        return f"Error in generate_response_with_rag: {e}"
+    finally:
+        finished.set()
+        cache_checked.set()
+        trace["timings"]["rag"] = time.perf_counter() - request_started
+        record_trace(trace)
+
+
+# Telegram update ids we've already accepted. The Mongo collection makes this hold across
+# gunicorn workers and restarts; the local cache saves the round-trip for hot redeliveries.
+UPDATE_ID_TTL = int(os.environ.get('UPDATE_ID_TTL', 86400))
+seen_updates = LRUCache("telegram_updates", maxsize=10000, ttl=UPDATE_ID_TTL)
+updates_index_ready = False
 
-        result = rag_chain.invoke(query)
 
-        print(prompt)
-        print(result)
-        return result
+def claim_update(update_id):
+    # Returns True the first time an update id is seen, False for redeliveries
+    from pymongo.errors import DuplicateKeyError
 
+    global updates_index_ready
+    if seen_updates.get(update_id):
+        return False
+    seen_updates.set(update_id, True)
+    try:
+        if not updates_index_ready:
+            collection('updates').create_index("received_at", expireAfterSeconds=UPDATE_ID_TTL)
+            updates_index_ready = True
+        collection('updates').insert_one({"_id": update_id, "received_at": datetime.now(timezone.utc)})
+    except DuplicateKeyError:
+        return False
     except Exception as e:
-        print(f"Error in generate_response_with_rag: {e}")
-        return f"Error in generate_response_with_rag: {e}"
+        # Better to risk a double answer than to drop the message
+        metrics.log_error("claim_update_failed", e, update_id=update_id)
+    return True
+
+
+def release_update(update_id):
+    # Forget an update we accepted but couldn't process, so Telegram's redelivery goes through
+    if update_id is None:
+        return
+    seen_updates.pop(update_id)
+    try:
+        collection('updates').delete_one({"_id": update_id})
+    except Exception as e:
+        metrics.log_error("release_update_failed", e, update_id=update_id)
+
+
+# History is one document per chat whose messages array is capped at HISTORY_MAX_MESSAGES,
+# well clear of Mongo's 16MB document limit. The last HISTORY_CACHE_MESSAGES of each chat are
+# kept in process (written through on every message), so get_chat_history rarely reads Mongo.
+# HISTORY_CACHE_TTL bounds how stale a chat can look to a worker that didn't do the last write.
+HISTORY_MAX_MESSAGES = int(os.environ.get('HISTORY_MAX_MESSAGES', 200))
+HISTORY_CACHE_MESSAGES = int(os.environ.get('HISTORY_CACHE_MESSAGES', 20))
+HISTORY_CACHE_CHATS = int(os.environ.get('HISTORY_CACHE_CHATS', 1000))
+HISTORY_CACHE_TTL = float(os.environ.get('HISTORY_CACHE_TTL', 300))
+recent_history_cache = LRUCache("chat_history", maxsize=HISTORY_CACHE_CHATS, ttl=HISTORY_CACHE_TTL)
+# Each chat's rolling summary as (summary, summarized_until), cached alongside its recent messages
+history_summary_cache = LRUCache("chat_summary", maxsize=HISTORY_CACHE_CHATS, ttl=HISTORY_CACHE_TTL)
+history_index_ready = False
+
+# With HISTORY_WRITE_BEHIND=1 history writes are buffered and flushed in bulk in the background
+# (see history_buffer.py), taking the Mongo write out of the reply path
+HISTORY_WRITE_BEHIND = os.environ.get('HISTORY_WRITE_BEHIND', '0') == '1'
+history_buffer = LazyClient(
+    "history_buffer", lambda: HistoryWriteBuffer(collection('history'), HISTORY_MAX_MESSAGES)
+) if HISTORY_WRITE_BEHIND else None
+
+
+def summarize_history(summary, transcript):
+    prompt = f"""
+    Update the summary of a conversation between a user and a chatbot with the messages below.
+    Keep names, facts, the user's preferences and anything the chatbot promised or was asked to remember.
+    Write plain prose in under {HISTORY_SUMMARY_WORDS} words and return only the summary.
+
+    <Summary>{summary or "None yet."}</Summary>
+    <Messages>{transcript}</Messages>
+
+    """
+    with upstream("gemini"):
+        return summarizer.get().generate_content(prompt).text
+
+
+def cache_history(chat_id, chat_session):
+    # Caches the recent messages and summary of a history document read from Mongo
+    recent_history_cache.set(chat_id, deque(chat_session.get("messages", []), maxlen=HISTORY_CACHE_MESSAGES))
+    history_summary_cache.set(chat_id, (chat_session.get("summary"), chat_session.get("summarized_until")))
+
+
+history_summarizer = LazyClient(
+    "history_summarizer",
+    lambda: HistorySummarizer(
+        collection('history'), summarize_history,
+        on_stored=lambda chat_id, summary, until: history_summary_cache.set(chat_id, (summary, until))
+    )
+) if HISTORY_SUMMARY else None
 
+
+def ensure_history_index():
+    global history_index_ready
+    if history_index_ready:
+        return
+    try:
+        collection('history').create_index("chat_id", unique=True)
+    except Exception as e:
+        # Older data may hold duplicate chat documents; an ordinary index still serves lookups
+        metrics.log_error("history_unique_index_failed", e)
+        collection('history').create_index("chat_id")
+    history_index_ready = True
+
+
+@metrics.timed("history_write")
 def manage_chat_history(chat_id, message, message_type):
-    # returns: A list of all messages in the session or a status message.
     try:
-        # Test collection read
-        test_query = history_db.find_one()
-        print("Sample document:", test_query)
+        ensure_history_index()
 
         # Create the chat message structure
         chat_message = {
@@ -275,38 +760,94 @@ def manage_chat_history(chat_id, message, message_type):
             "content": message,
         }
 
-        # Use upsert to add messages to the chat session
-        history_db.update_one(
-            {"chat_id": chat_id},  # Find the document by chat_id
-            # Push the new message to the 'messages' array
-            {"$push": {"messages": chat_message}},
-            upsert=True  # Create the document if it doesn't exist
-        )
+        if history_buffer:
+            history_buffer.get().add(chat_id, chat_message)
+            cached = recent_history_cache.get(chat_id)
+            if cached is not None:
+                cached.append(chat_message)
+            return
 
-        print("collection updated successfully")
+        # One round-trip: append under the cap, upsert the chat, and get back the recent window
+        from pymongo import ReturnDocument
+        chat_session = collection('history').find_one_and_update(
+            {"chat_id": chat_id},
+            {"$push": {"messages": {"$each": [chat_message], "$slice": -HISTORY_MAX_MESSAGES}}},
+            projection={"_id": 0, "messages": {"$slice": -HISTORY_CACHE_MESSAGES}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        cache_history(chat_id, chat_session)
     except Exception as e:
-        print("Error:", e)
+        metrics.log_error("history_write_failed", e, stage="history_write", chat_id=chat_id)
 
 
+@metrics.timed("history_read")
 def get_chat_history(chat_id, k=5):
     try:
-        # Get last k messages from chat history
-        chat_session = history_db.find_one(
-            {"chat_id": chat_id},
-            {"messages": {"$slice": -(k*2)}}  # Get last k messages
-        )
-
-        if not chat_session or "messages" not in chat_session:
-            return []
+        # Get last k turns (a user message and a reply each) from chat history, or with
+        # HISTORY_SUMMARY the summary of the earlier turns plus at most k turns after it
+        cacheable = k * 2 <= HISTORY_CACHE_MESSAGES
+        messages = recent_history_cache.get(chat_id) if cacheable else None
+        summary_state = history_summary_cache.get(chat_id) if cacheable else None
+        if messages is None or summary_state is None:
+            # Snapshot unflushed writes before reading, so a flush landing in between can't hide them
+            pending = history_buffer.get().pending(chat_id) if history_buffer else []
+            chat_session = collection('history').find_one(
+                {"chat_id": chat_id},
+                {"_id": 0, "messages": {"$slice": -max(k * 2, HISTORY_CACHE_MESSAGES)}}
+            )
+            chat_session = chat_session or {}
+            messages = chat_session.get("messages", [])
+            if pending:
+                stored = {message_key(msg) for msg in messages}
+                messages = messages + [msg for msg in pending if message_key(msg) not in stored]
+            summary_state = (chat_session.get("summary"), chat_session.get("summarized_until"))
+            if cacheable:
+                cache_history(chat_id, {**chat_session, "messages": messages})
+
+        summary, summarized_until = summary_state if history_summarizer else (None, None)
+        if history_summarizer:
+            messages = unsummarized(messages, summarized_until)
+            history_summarizer.get().maybe_schedule(chat_id, messages, summary, summarized_until)
+        recent = list(messages)[-(k * 2):]
+        if not recent and not summary:
+            return "No previous conversation."
 
         # Format messages for the prompt
-        formatted_history = []
-        for msg in chat_session["messages"]:
+        formatted_history = [SUMMARY_LABEL + " ".join(summary.split())] if summary else []
+        for msg in recent:
             role = "User" if msg["type"] == "user" else "Assistant"
             formatted_history.append(f"{role}: {msg['content']}")
 
         return "\n".join(formatted_history)
 
     except Exception as e:
-        print(f"Error retrieving chat history: {str(e)}")
+        metrics.log_error("history_read_failed", e, stage="history_read", chat_id=chat_id)
         return "Error retrieving chat history."
+
+
+def warm_up(timeout=WARM_UP_TIMEOUT):
+    # Builds every client and opens the connections the first request would otherwise pay for,
+    # all in parallel and for at most timeout seconds, so a hung upstream can't stall startup.
+    # Called from gunicorn's post_fork hook (see gunicorn.conf.py). Returns the steps that didn't finish.
+    def ping_mongo():
+        mongo.get().admin.command('ping')
+
+    def connect_vector_backend():
+        if VECTOR_BACKEND == 'local':
+            return
+        import langchain_pinecone  # noqa: F401
+        if PINECONE_INDEX_MODE == 'shared':
+            ensure_index(PINECONE_SHARED_INDEX)
+        else:
+            with index_lock:
+                known_indexes.update(pinecone.get().list_indexes().names())
+
+    def import_document_loaders():
+        import langchain.text_splitter  # noqa: F401
+        import langchain_community.document_loaders  # noqa: F401
+
+    started = time.perf_counter()
+    unfinished = warm_up_clients(timeout=timeout, extra=(ping_mongo, connect_vector_backend, import_document_loaders))
+    metrics.log_event("warm_up", seconds=round(time.perf_counter() - started, 3), unfinished=unfinished)
+    return unfinished
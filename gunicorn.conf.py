@@ -0,0 +1,34 @@
+# gunicorn -c gunicorn.conf.py app:app
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 8000)}"
+# One process by default: per-chat ordering, coalescing and stale-answer cancellation
+# (updates.py) only hold within a process, and with several workers two messages from the same
+# chat can be handled at once, racing on its history and character. The work is I/O bound,
+# so threads add capacity without that cost.
+workers = int(os.environ.get('WEB_CONCURRENCY', 1))
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 120))
+
+# Not preloaded: app.py starts the job queue and webhook worker threads at import,
+# and threads don't survive the fork
+preload_app = False
+
+# With WARM_UP=1 each worker connects to Gemini, Mongo and Pinecone before taking requests,
+# for at most WARM_UP_TIMEOUT seconds, instead of on its first message
+WARM_UP = os.environ.get('WARM_UP', '1') == '1'
+
+
+def on_starting(server):
+    if workers > 1:
+        server.log.warning(f"Running {workers} workers: messages from one chat may be handled concurrently "
+                           "by different workers")
+
+
+def post_fork(server, worker):
+    if not WARM_UP:
+        return
+    import functions
+    unfinished = functions.warm_up()
+    if unfinished:
+        server.log.warning(f"Worker {worker.pid} warm-up did not finish: {', '.join(unfinished)}")
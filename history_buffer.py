@@ -0,0 +1,92 @@
+import atexit
+import os
+import threading
+
+import metrics
+
+# Flush once this many messages are waiting, or every HISTORY_FLUSH_INTERVAL seconds, whichever comes first
+HISTORY_FLUSH_SIZE = int(os.environ.get('HISTORY_FLUSH_SIZE', 50))
+HISTORY_FLUSH_INTERVAL = float(os.environ.get('HISTORY_FLUSH_INTERVAL', 2))
+
+
+def message_key(message):
+    # Identity of a history message that survives a round-trip through Mongo,
+    # which drops the timezone and keeps only millisecond precision
+    ts = message["timestamp"]
+    return message["type"], message["content"], ts.replace(microsecond=ts.microsecond // 1000 * 1000, tzinfo=None)
+
+
+class HistoryWriteBuffer:
+    # Write-behind buffer for chat history: messages are collected per chat and written with one
+    # bulk_write per flush instead of one blocking update per message. pending() exposes what
+    # hasn't reached Mongo yet so readers can still see their own writes.
+
+    def __init__(self, collection, max_messages, flush_size=HISTORY_FLUSH_SIZE, flush_interval=HISTORY_FLUSH_INTERVAL):
+        self.collection = collection
+        self.max_messages = max_messages
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self._pending = {}
+        self._flushing = {}
+        self._count = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = False
+        threading.Thread(target=self._run, name="history-flush", daemon=True).start()
+        atexit.register(self.close)
+
+    def add(self, chat_id, message):
+        with self._lock:
+            self._pending.setdefault(chat_id, []).append(message)
+            self._count += 1
+            if self._count >= self.flush_size:
+                self._wakeup.set()
+
+    def pending(self, chat_id):
+        # Messages for chat_id not yet confirmed written, oldest first
+        with self._lock:
+            return self._flushing.get(chat_id, []) + self._pending.get(chat_id, [])
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return
+                self._flushing, self._pending = self._pending, {}
+                self._count = 0
+            batch = self._flushing
+
+            from pymongo import UpdateOne
+            operations = [
+                UpdateOne(
+                    {"chat_id": chat_id},
+                    {"$push": {"messages": {"$each": messages, "$slice": -self.max_messages}}},
+                    upsert=True
+                )
+                for chat_id, messages in batch.items()
+            ]
+            try:
+                self.collection.bulk_write(operations, ordered=False)
+            except Exception as e:
+                # Put the batch back in front of anything that arrived meanwhile and retry next flush.
+                # On a partial failure some chats may be written twice, which beats losing them.
+                metrics.log_error("history_flush_failed", e, stage="history_flush", chats=len(batch))
+                with self._lock:
+                    for chat_id, messages in batch.items():
+                        self._pending[chat_id] = messages + self._pending.get(chat_id, [])
+                        self._count += len(messages)
+            finally:
+                with self._lock:
+                    self._flushing = {}
+
+    def _run(self):
+        while not self._stopped:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def close(self):
+        self._stopped = True
+        self._wakeup.set()
+        self.flush()
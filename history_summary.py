@@ -0,0 +1,89 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from history_buffer import message_key
+from prompt_builder import estimate_tokens
+
+# Rolling memory: once the turns older than the last HISTORY_RECENT_TURNS add up to
+# HISTORY_SUMMARY_TRIGGER_TOKENS, they are folded into a running summary in the background.
+# The prompt then gets the summary plus the turns after it, so it stays flat as a chat grows.
+HISTORY_SUMMARY = os.environ.get('HISTORY_SUMMARY', '1') == '1'
+HISTORY_RECENT_TURNS = int(os.environ.get('HISTORY_RECENT_TURNS', 2))
+HISTORY_SUMMARY_TRIGGER_TOKENS = int(os.environ.get('HISTORY_SUMMARY_TRIGGER_TOKENS', 400))
+# Length the summary is asked to stay under
+HISTORY_SUMMARY_WORDS = int(os.environ.get('HISTORY_SUMMARY_WORDS', 150))
+HISTORY_SUMMARY_WORKERS = int(os.environ.get('HISTORY_SUMMARY_WORKERS', 2))
+
+
+def message_time(message):
+    # Comparable across in-process messages and ones read back from Mongo (see message_key)
+    return message_key(message)[2]
+
+
+def unsummarized(messages, summarized_until):
+    # The messages newer than the last one folded into the summary, oldest first
+    if summarized_until is None:
+        return list(messages)
+    return [msg for msg in messages if message_time(msg) > summarized_until]
+
+
+def format_messages(messages):
+    return "\n".join(
+        f"{'User' if msg['type'] == 'user' else 'Assistant'}: {msg['content']}" for msg in messages
+    )
+
+
+class HistorySummarizer:
+    # Keeps a running summary of each chat's older turns in its history document, next to the
+    # messages: summary holds the text and summarized_until the timestamp of the newest message
+    # folded into it. At most one summary per chat is in flight, and a summary only replaces an
+    # older one, so concurrent workers can't move a chat's memory backwards.
+
+    def __init__(self, collection, summarize, on_stored=None, workers=HISTORY_SUMMARY_WORKERS,
+                 recent_turns=HISTORY_RECENT_TURNS, trigger_tokens=HISTORY_SUMMARY_TRIGGER_TOKENS):
+        # summarize(previous_summary, transcript) returns the new summary text;
+        # on_stored(chat_id, summary, summarized_until) is called after it is written
+        self.collection = collection
+        self.summarize = summarize
+        self.on_stored = on_stored
+        self.recent_turns = recent_turns
+        self.trigger_tokens = trigger_tokens
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="history-summary")
+        self._running = set()
+        self._lock = threading.Lock()
+
+    def maybe_schedule(self, chat_id, messages, summary, summarized_until):
+        # Starts a summary if the unsummarized turns before the recent ones are over the threshold.
+        # Returns True if one was started.
+        pending = unsummarized(messages, summarized_until)
+        older = pending[:-self.recent_turns * 2] if self.recent_turns else pending
+        if not older or estimate_tokens(format_messages(older)) < self.trigger_tokens:
+            return False
+        with self._lock:
+            if chat_id in self._running:
+                return False
+            self._running.add(chat_id)
+        self._pool.submit(self._run, chat_id, older, summary)
+        return True
+
+    def _run(self, chat_id, older, summary):
+        try:
+            with metrics.timer("history_summary"):
+                new_summary = self.summarize(summary, format_messages(older)).strip()
+            until = message_time(older[-1])
+            result = self.collection.update_one(
+                {"chat_id": chat_id, "$or": [{"summarized_until": {"$lt": until}},
+                                             {"summarized_until": {"$exists": False}}]},
+                {"$set": {"summary": new_summary, "summarized_until": until}}
+            )
+            # No match: another worker stored a newer summary, or (with write-behind) the chat's
+            # document isn't written yet and the next read will try again
+            if result.matched_count and self.on_stored:
+                self.on_stored(chat_id, new_summary, until)
+        except Exception as e:
+            metrics.log_error("history_summary_failed", e, stage="history_summary", chat_id=chat_id)
+        finally:
+            with self._lock:
+                self._running.discard(chat_id)
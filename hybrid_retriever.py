@@ -0,0 +1,29 @@
+from typing import Any
+
+from langchain_core.retrievers import BaseRetriever
+
+import metrics
+from keyword_index import reciprocal_rank_fusion, rerank
+
+
+class HybridRetriever(BaseRetriever):
+    # Dense results fused with BM25 keyword results by reciprocal rank fusion, optionally reranked
+    vector_retriever: BaseRetriever
+    keyword_index: Any
+    chat_id: str
+    k: int = 5
+    keyword_k: int = 10
+    use_reranker: bool = False
+
+    def _get_relevant_documents(self, query, *, run_manager=None):
+        dense = self.vector_retriever.invoke(query)
+        try:
+            keyword = self.keyword_index.search(self.chat_id, query, self.keyword_k)
+        except Exception as e:
+            metrics.log_error("keyword_search_failed", e, stage="keyword_search", chat_id=self.chat_id)
+            metrics.increment("degraded_total", source="keyword")
+            keyword = []
+        fused = reciprocal_rank_fusion([dense, keyword])
+        if self.use_reranker:
+            fused = rerank(query, fused)
+        return [doc for doc, _ in fused[:self.k]]
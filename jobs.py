@@ -0,0 +1,204 @@
+import os
+import socket
+import sqlite3
+import threading
+import time
+import traceback
+
+import metrics
+
+JOBS_DB_PATH = os.environ.get('JOBS_DB_PATH', 'jobs.sqlite3')
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', 3))
+# Seconds before a failed job is retried; doubles with every attempt
+JOB_RETRY_DELAY = float(os.environ.get('JOB_RETRY_DELAY', 30))
+# A running job whose lease isn't renewed within this many seconds is assumed lost
+# (worker crashed or was redeployed) and is picked up again by any worker
+JOB_LEASE = float(os.environ.get('JOB_LEASE', 120))
+JOB_POLL_INTERVAL = float(os.environ.get('JOB_POLL_INTERVAL', 2))
+
+
+class JobQueue:
+    # Persistent document-processing queue on SQLite with a bounded pool of worker threads.
+    #
+    # Jobs are unique per (chat_id, file_hash), so re-sending a book that is queued, running or
+    # already indexed doesn't process it again. Workers claim jobs with a lease they keep renewing;
+    # when a process dies its jobs' leases lapse and another worker (or the restarted one) resumes
+    # them. Failed jobs are retried with backoff up to max_attempts.
+
+    def __init__(self, handler, path=JOBS_DB_PATH, workers=JOB_WORKERS,
+                 max_attempts=JOB_MAX_ATTEMPTS, retry_delay=JOB_RETRY_DELAY):
+        # handler(job, final_attempt) processes one job dict and raises on failure
+        self.handler = handler
+        self.path = path
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self._local = threading.local()
+        self._wakeup = threading.Event()
+        self._running = set()
+        self._running_lock = threading.Lock()
+        self._threads = []
+
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                " chat_id TEXT NOT NULL,"
+                " file_hash TEXT NOT NULL,"
+                " file_path TEXT NOT NULL,"
+                " status TEXT NOT NULL,"  # queued, running, done, failed
+                " attempts INTEGER NOT NULL DEFAULT 0,"
+                " error TEXT,"
+                " owner TEXT,"
+                " run_after REAL NOT NULL,"
+                " lease_expires REAL,"
+                " created_at REAL NOT NULL,"
+                " updated_at REAL NOT NULL,"
+                " UNIQUE (chat_id, file_hash))"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, run_after)")
+
+    def _connect(self):
+        # One connection per thread; SQLite serialises writers across threads and processes
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return _Transaction(conn)
+
+    def start(self):
+        if self._threads:
+            return
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"job-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        threading.Thread(target=self._heartbeat, name="job-heartbeat", daemon=True).start()
+
+    def enqueue(self, chat_id, file_path, file_hash):
+        # Returns (job, created). created is False when the same file is already queued, running
+        # or done for this chat; a job that failed for good is reset and queued again.
+        now = time.time()
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO jobs (chat_id, file_hash, file_path, status, run_after, created_at, updated_at)"
+                " VALUES (?, ?, ?, 'queued', ?, ?, ?)",
+                (str(chat_id), file_hash, file_path, now, now, now)
+            )
+            created = cursor.rowcount == 1
+            if not created:
+                cursor = conn.execute(
+                    "UPDATE jobs SET status = 'queued', file_path = ?, attempts = 0, error = NULL,"
+                    " run_after = ?, updated_at = ? WHERE chat_id = ? AND file_hash = ? AND status = 'failed'",
+                    (file_path, now, now, str(chat_id), file_hash)
+                )
+                created = cursor.rowcount == 1
+            job = conn.execute(
+                "SELECT * FROM jobs WHERE chat_id = ? AND file_hash = ?", (str(chat_id), file_hash)
+            ).fetchone()
+        self._wakeup.set()
+        return dict(job), created
+
+    def status(self, chat_id, limit=10):
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT * FROM jobs WHERE chat_id = ? ORDER BY created_at DESC LIMIT ?", (str(chat_id), limit)
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def _claim(self):
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT id FROM jobs WHERE (status = 'queued' AND run_after <= ?)"
+                " OR (status = 'running' AND lease_expires < ?) ORDER BY run_after LIMIT 1",
+                (now, now)
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE jobs SET status = 'running', owner = ?, attempts = attempts + 1,"
+                " lease_expires = ?, updated_at = ? WHERE id = ?",
+                (self.owner, now + JOB_LEASE, now, row["id"])
+            )
+            job = conn.execute("SELECT * FROM jobs WHERE id = ?", (row["id"],)).fetchone()
+        return dict(job)
+
+    def _finish(self, job_id, status, error=None, run_after=None):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, run_after = COALESCE(?, run_after),"
+                " lease_expires = NULL, updated_at = ? WHERE id = ?",
+                (status, error, run_after, now, job_id)
+            )
+
+    def _work(self):
+        while True:
+            try:
+                job = self._claim()
+            except Exception as e:
+                metrics.log_error("job_claim_failed", e, stage="jobs")
+                job = None
+            if job is None:
+                self._wakeup.wait(JOB_POLL_INTERVAL)
+                self._wakeup.clear()
+                continue
+
+            final_attempt = job["attempts"] >= self.max_attempts
+            with self._running_lock:
+                self._running.add(job["id"])
+            try:
+                self.handler(job, final_attempt)
+                self._finish(job["id"], "done")
+            except Exception as e:
+                metrics.log_error("job_failed", e, stage="document_job", job_id=job["id"], attempt=job["attempts"],
+                                  final=final_attempt, traceback=traceback.format_exc())
+                if final_attempt:
+                    self._finish(job["id"], "failed", error=str(e))
+                else:
+                    backoff = self.retry_delay * 2 ** (job["attempts"] - 1)
+                    self._finish(job["id"], "queued", error=str(e), run_after=time.time() + backoff)
+            finally:
+                with self._running_lock:
+                    self._running.discard(job["id"])
+
+    def _heartbeat(self):
+        while True:
+            time.sleep(JOB_LEASE / 3)
+            with self._running_lock:
+                running = list(self._running)
+            if not running:
+                continue
+            try:
+                with self._connect() as conn:
+                    conn.executemany(
+                        "UPDATE jobs SET lease_expires = ? WHERE id = ? AND status = 'running'",
+                        [(time.time() + JOB_LEASE, job_id) for job_id in running]
+                    )
+            except Exception as e:
+                metrics.log_error("job_lease_renew_failed", e, stage="jobs")
+
+
+class _Transaction:
+    # BEGIN IMMEDIATE ... COMMIT around a block, so a claim can't be taken by two workers at once
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+
+    def execute(self, *args):
+        return self.conn.execute(*args)
+
+    def executemany(self, *args):
+        return self.conn.executemany(*args)
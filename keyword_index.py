@@ -0,0 +1,105 @@
+import json
+import os
+import sqlite3
+import threading
+
+from prompt_builder import WORD, query_terms
+
+KEYWORD_INDEX_PATH = os.environ.get('KEYWORD_INDEX_PATH', 'keyword_index.sqlite3')
+# Constant in reciprocal rank fusion: score = sum(1 / (RRF_K + rank)) over the result lists
+RRF_K = 60
+# How much the reranker's query-term coverage counts against the fused rank score
+RERANK_WEIGHT = 0.05
+
+
+class KeywordIndex:
+    # BM25 keyword index over every chat's chunks, on SQLite FTS5. Dense retrieval misses exact
+    # spell names and proper nouns ("Protego"); term matching finds them.
+    # chat_id is an indexed column and part of the MATCH expression, so a search only scores the
+    # chat's own chunks. Each thread has its own connection: in WAL mode searches don't wait for
+    # each other or for an ingest, and writers queue on SQLite's own lock.
+
+    def __init__(self, path=KEYWORD_INDEX_PATH):
+        self.path = path
+        self._local = threading.local()
+        conn = self._connection()
+        conn.execute("PRAGMA journal_mode=WAL")
+        with conn:
+            conn.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS chat_chunks USING fts5("
+                " chat_id, doc_id UNINDEXED, metadata UNINDEXED, text, tokenize='porter unicode61')"
+            )
+            # Indexes built before chat_id was searchable kept it UNINDEXED in "chunks"
+            if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'chunks'").fetchone():
+                conn.execute("INSERT INTO chat_chunks (chat_id, doc_id, metadata, text)"
+                             " SELECT chat_id, doc_id, metadata, text FROM chunks")
+                conn.execute("DROP TABLE chunks")
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(self.path, timeout=30)
+        return conn
+
+    def add(self, chat_id, ids, documents):
+        # Same id replaces the stored chunk, like an upsert into the vector store
+        rows = [
+            (str(chat_id), doc_id, json.dumps(doc.metadata, default=str), doc.page_content)
+            for doc_id, doc in zip(ids, documents)
+        ]
+        placeholders = ",".join("?" * len(ids))
+        with self._connection() as conn:
+            conn.execute(
+                f"DELETE FROM chat_chunks WHERE chat_chunks MATCH ? AND chat_id = ? AND doc_id IN ({placeholders})",
+                [chat_filter(chat_id), str(chat_id), *ids]
+            )
+            conn.executemany("INSERT INTO chat_chunks (chat_id, doc_id, metadata, text) VALUES (?, ?, ?, ?)", rows)
+
+    def search(self, chat_id, query, k=10):
+        from langchain_core.documents import Document
+        terms = query_terms(query)
+        if not terms:
+            return []
+        match = chat_filter(chat_id) + " AND text : (" + " OR ".join(f'"{term}"' for term in terms) + ")"
+        # The MATCH narrows to the chat's tokens; chat_id = ? keeps ids that tokenize alike apart
+        rows = self._connection().execute(
+            "SELECT doc_id, metadata, text FROM chat_chunks WHERE chat_chunks MATCH ? AND chat_id = ?"
+            " ORDER BY bm25(chat_chunks, 0.0, 0.0, 0.0, 1.0) LIMIT ?",
+            (match, str(chat_id), k)
+        ).fetchall()
+        return [Document(id=doc_id, page_content=text, metadata=json.loads(metadata)) for doc_id, metadata, text in rows]
+
+
+def chat_filter(chat_id):
+    # FTS5 expression for the chat's rows, as a phrase so "-100123" and "eval-default" match whole
+    return 'chat_id : "' + str(chat_id).replace('"', '""') + '"'
+
+
+def document_key(doc):
+    return doc.id or doc.page_content
+
+
+def reciprocal_rank_fusion(result_lists, rrf_k=RRF_K):
+    # Returns (document, score) pairs, best first
+    scores, docs = {}, {}
+    for results in result_lists:
+        for rank, doc in enumerate(results):
+            key = document_key(doc)
+            docs.setdefault(key, doc)
+            scores[key] = scores.get(key, 0.0) + 1.0 / (rrf_k + rank + 1)
+    return sorted(((docs[key], score) for key, score in scores.items()), key=lambda pair: -pair[1])
+
+
+def keyword_coverage(query, text):
+    # Share of the query's content words that appear in text
+    terms = query_terms(query)
+    if not terms:
+        return 0.0
+    words = set(WORD.findall(text.lower()))
+    return len(terms & words) / len(terms)
+
+
+def rerank(query, scored_docs):
+    # Cheap local reranker: nudge the fused order towards chunks that contain more of the query's terms
+    rescored = [(doc, score + RERANK_WEIGHT * keyword_coverage(query, doc.page_content)) for doc, score in scored_docs]
+    return sorted(rescored, key=lambda pair: -pair[1])
@@ -0,0 +1,154 @@
+import json
+import os
+import threading
+import uuid
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.vectorstores import VectorStore
+
+
+class LocalVectorStore(VectorStore):
+    # In-process vector store for one chat: a float32 matrix of unit-normalised embeddings,
+    # persisted as vectors.npy (memory-mapped on load) next to docs.jsonl holding ids, text
+    # and metadata. Cosine top-k is a single matrix-vector product.
+    #
+    # Writes rewrite both files atomically, which is fine for per-chat corpora such as one
+    # novel. Other processes pick up a rewrite on their next search via the file mtime.
+
+    def __init__(self, directory, embedding):
+        self.directory = directory
+        self._embedding = embedding
+        self._vectors_path = os.path.join(directory, "vectors.npy")
+        self._docs_path = os.path.join(directory, "docs.jsonl")
+        self._lock = threading.Lock()
+        self._loaded_mtime = None
+        self._vectors = None
+        self._docs = []
+        self._positions = {}
+        os.makedirs(directory, exist_ok=True)
+
+    @property
+    def embeddings(self):
+        return self._embedding
+
+    def _load(self):
+        # Caller holds the lock
+        try:
+            mtime = os.path.getmtime(self._vectors_path)
+        except FileNotFoundError:
+            self._vectors, self._docs, self._positions = None, [], {}
+            self._loaded_mtime = None
+            return
+        if mtime == self._loaded_mtime:
+            return
+        self._vectors = np.load(self._vectors_path, mmap_mode="r")
+        with open(self._docs_path, encoding="utf-8") as f:
+            self._docs = [json.loads(line) for line in f]
+        # Another process may be between its two renames; serve the rows both files agree on
+        n = min(len(self._vectors), len(self._docs))
+        self._vectors, self._docs = self._vectors[:n], self._docs[:n]
+        self._positions = {doc["id"]: i for i, doc in enumerate(self._docs)}
+        self._loaded_mtime = mtime
+
+    def _save(self, vectors, docs):
+        # Caller holds the lock. Write to temp files and swap them in so readers never see half a file.
+        vectors_tmp = self._vectors_path + ".tmp.npy"
+        docs_tmp = self._docs_path + ".tmp"
+        np.save(vectors_tmp, vectors)
+        with open(docs_tmp, "w", encoding="utf-8") as f:
+            for doc in docs:
+                f.write(json.dumps(doc, default=str) + "\n")
+        os.replace(docs_tmp, self._docs_path)
+        os.replace(vectors_tmp, self._vectors_path)
+        self._loaded_mtime = None
+        self._load()
+
+    @staticmethod
+    def _normalise(matrix):
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return matrix / norms
+
+    def add_texts(self, texts, metadatas=None, *, ids=None, **kwargs):
+        texts = list(texts)
+        if not texts:
+            return []
+        metadatas = metadatas or [{} for _ in texts]
+        ids = list(ids) if ids else [str(uuid.uuid4()) for _ in texts]
+        new_vectors = self._normalise(np.asarray(self._embedding.embed_documents(texts), dtype=np.float32))
+
+        with self._lock:
+            self._load()
+            docs = list(self._docs)
+            vectors = np.array(self._vectors) if self._vectors is not None else np.empty((0, new_vectors.shape[1]), dtype=np.float32)
+
+            # Same id overwrites in place, like a Pinecone upsert
+            appended = []
+            for i, (doc_id, text, metadata) in enumerate(zip(ids, texts, metadatas)):
+                doc = {"id": doc_id, "text": text, "metadata": metadata}
+                position = self._positions.get(doc_id)
+                if position is None:
+                    appended.append(i)
+                    docs.append(doc)
+                else:
+                    vectors[position] = new_vectors[i]
+                    docs[position] = doc
+            if appended:
+                vectors = np.concatenate([vectors, new_vectors[appended]])
+            self._save(vectors, docs)
+        return ids
+
+    def delete(self, ids=None, **kwargs):
+        with self._lock:
+            self._load()
+            if self._vectors is None:
+                return True
+            if ids is None:
+                keep = []
+            else:
+                drop = set(ids)
+                keep = [i for i, doc in enumerate(self._docs) if doc["id"] not in drop]
+            self._save(np.array(self._vectors[keep]), [self._docs[i] for i in keep])
+        return True
+
+    def similarity_search_by_vector_with_score(self, embedding, k=4, **kwargs):
+        query = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        if norm:
+            query = query / norm
+
+        with self._lock:
+            self._load()
+            vectors, docs = self._vectors, self._docs
+        if vectors is None or not len(docs):
+            return []
+
+        scores = vectors @ query
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [
+            (Document(id=docs[i]["id"], page_content=docs[i]["text"], metadata=docs[i]["metadata"]), float(scores[i]))
+            for i in top
+        ]
+
+    def similarity_search_with_score(self, query, k=4, **kwargs):
+        return self.similarity_search_by_vector_with_score(self._embedding.embed_query(query), k=k, **kwargs)
+
+    def similarity_search_by_vector(self, embedding, k=4, **kwargs):
+        return [doc for doc, _ in self.similarity_search_by_vector_with_score(embedding, k=k, **kwargs)]
+
+    def similarity_search(self, query, k=4, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score(query, k=k, **kwargs)]
+
+    def _select_relevance_score_fn(self):
+        # Same mapping of cosine similarity to [0, 1] as the Pinecone store, so
+        # score_threshold means the same thing on both backends
+        return lambda score: (score + 1) / 2
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, *, ids=None, directory=None, **kwargs):
+        store = cls(directory or os.path.join("vector_data", str(uuid.uuid4())), embedding)
+        store.add_texts(texts, metadatas=metadatas, ids=ids)
+        return store
@@ -0,0 +1,151 @@
+import functools
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+from caching import caches
+
+# Process-local metrics, rendered in the Prometheus text format by app.py's /metrics route.
+# Under gunicorn every worker keeps its own numbers; scrape each worker or run one per port.
+METRIC_PREFIX = "llm_chatbot"
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Share of requests whose trace is logged; errors are always logged
+LOG_SAMPLE_RATE = float(os.environ.get('LOG_SAMPLE_RATE', 0.01))
+# Include the full prompt in sampled RAG traces
+LOG_PROMPTS = os.environ.get('LOG_PROMPTS', '0') == '1'
+
+logger = logging.getLogger(METRIC_PREFIX)
+if not logger.handlers:
+    _handler = logging.StreamHandler(sys.stdout)
+    _handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(_handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+_lock = threading.Lock()
+_histograms = {}
+_counters = {}
+_gauges = {}
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.total += value
+
+
+def observe(stage, seconds):
+    with _lock:
+        histogram = _histograms.get(stage)
+        if histogram is None:
+            histogram = _histograms[stage] = Histogram()
+        histogram.observe(seconds)
+
+
+def increment(name, amount=1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+def set_gauge(name, value):
+    with _lock:
+        _gauges[name] = value
+
+
+@contextmanager
+def timer(stage):
+    # Records how long the block took under stage, and counts it as an error if it raised
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        increment("errors_total", stage=stage)
+        raise
+    finally:
+        observe(stage, time.perf_counter() - start)
+
+
+def timed(stage):
+    # Decorator form of timer
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with timer(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def sampled():
+    return random.random() < LOG_SAMPLE_RATE
+
+
+def log_event(event, **fields):
+    # One JSON object per line
+    logger.info(json.dumps({"event": event, "time": round(time.time(), 3), **fields}, default=str))
+
+
+def log_error(event, error, stage=None, **fields):
+    if stage:
+        increment("errors_total", stage=stage)
+    logger.error(json.dumps({"event": event, "error": str(error), "time": round(time.time(), 3), **fields}, default=str))
+
+
+def _labels(pairs):
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in pairs) + "}"
+
+
+def render():
+    lines = []
+    with _lock:
+        name = f"{METRIC_PREFIX}_stage_seconds"
+        lines.append(f"# TYPE {name} histogram")
+        for stage, histogram in sorted(_histograms.items()):
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'{name}_bucket{{stage="{stage}",le="+Inf"}} {histogram.count}')
+            lines.append(f'{name}_sum{{stage="{stage}"}} {histogram.total}')
+            lines.append(f'{name}_count{{stage="{stage}"}} {histogram.count}')
+
+        for counter in sorted({name for name, _ in _counters}):
+            lines.append(f"# TYPE {METRIC_PREFIX}_{counter} counter")
+            for (name, labels), value in sorted(_counters.items()):
+                if name == counter:
+                    lines.append(f"{METRIC_PREFIX}_{name}{_labels(labels)} {value}")
+
+        for name, value in sorted(_gauges.items()):
+            lines.append(f"# TYPE {METRIC_PREFIX}_{name} gauge")
+            lines.append(f"{METRIC_PREFIX}_{name} {value}")
+
+    cache_stats = {name: cache.stats() for name, cache in list(caches.items())}
+    for stat, kind in (("hits", "counter"), ("misses", "counter"), ("evictions", "counter"),
+                       ("hit_rate", "gauge"), ("size", "gauge")):
+        values = [(name, stats[stat]) for name, stats in sorted(cache_stats.items()) if stat in stats]
+        if not values:
+            continue
+        suffix = "_total" if kind == "counter" else ""
+        lines.append(f"# TYPE {METRIC_PREFIX}_cache_{stat}{suffix} {kind}")
+        for name, value in values:
+            lines.append(f'{METRIC_PREFIX}_cache_{stat}{suffix}{{cache="{name}"}} {value}')
+    return "\n".join(lines) + "\n"
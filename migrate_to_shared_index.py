@@ -0,0 +1,85 @@
+# Copies the per-chat Pinecone indexes into the shared index, one namespace per chat.
+#
+#   python migrate_to_shared_index.py                  # migrate every per-chat index (named by chat id)
+#   python migrate_to_shared_index.py --chats 123 456  # migrate only these chats
+#   python migrate_to_shared_index.py --dry-run        # only report what would be copied
+#   python migrate_to_shared_index.py --delete-source  # drop each source index once its counts match
+#
+# Run it before switching PINECONE_INDEX_MODE to "shared". Re-running is safe because
+# vectors keep their ids and upserts overwrite.
+import argparse
+
+from functions import pinecone, ensure_index, PINECONE_SHARED_INDEX
+
+BATCH_SIZE = 100
+
+
+def vector_count(index, namespace=""):
+    stats = index.describe_index_stats()
+    summary = stats.namespaces.get(namespace)
+    return summary.vector_count if summary else 0
+
+
+def is_chat_index(name):
+    # Per-chat indexes are named after the Telegram chat id, which is negative for groups
+    return name.lstrip('-').isdigit()
+
+
+def migrate_index(name, shared_index, dry_run=False):
+    source = pinecone.get().Index(name)
+    total = vector_count(source)
+    print(f"{name}: {total} vectors")
+    if dry_run:
+        return total, total
+
+    copied = 0
+    # list() pages through the ids of a serverless index
+    for ids in source.list():
+        for start in range(0, len(ids), BATCH_SIZE):
+            batch = ids[start:start + BATCH_SIZE]
+            fetched = source.fetch(ids=batch).vectors
+            shared_index.upsert(
+                vectors=[(v.id, v.values, v.metadata) for v in fetched.values()],
+                namespace=name
+            )
+            copied += len(fetched)
+        print(f"{name}: copied {copied}/{total}")
+    return copied, total
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Copy per-chat Pinecone indexes into the shared index")
+    parser.add_argument("--chats", nargs="*", help="chat ids to migrate (default: every index named by a chat id)")
+    parser.add_argument("--dry-run", action="store_true", help="only print what would be copied")
+    parser.add_argument("--delete-source", action="store_true", help="delete a source index after a verified copy")
+    args = parser.parse_args()
+
+    names = args.chats or [n for n in pinecone.get().list_indexes().names() if is_chat_index(n)]
+
+    # A dry run only reads the source indexes, so it doesn't create the shared one
+    shared_index = None
+    if not args.dry_run:
+        ensure_index(PINECONE_SHARED_INDEX)
+        shared_index = pinecone.get().Index(PINECONE_SHARED_INDEX)
+
+    for name in names:
+        try:
+            copied, total = migrate_index(name, shared_index, dry_run=args.dry_run)
+        except Exception as e:
+            print(f"{name}: migration failed: {e}")
+            continue
+
+        if args.delete_source and not args.dry_run:
+            # Every source vector must have been copied and be visible in the shared namespace.
+            # Stats on serverless indexes are eventually consistent; keep the source until they catch up.
+            in_shared = vector_count(shared_index, namespace=name)
+            if copied == total and in_shared >= total:
+                pinecone.get().delete_index(name)
+                print(f"{name}: deleted source index")
+            else:
+                print(f"{name}: copied {copied}, shared namespace has {in_shared} of {total} vectors, "
+                      f"keeping source index")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+import math
+import re
+
+# Local first pass for classify(). Nearly every message is an ordinary question, so most
+# are settled here and only the ambiguous ones are sent to the LLM classifier.
+#
+# detect_persona(query) returns one of
+#   ("set", name)       - a clear request to become a named character
+#   ("none", None)      - no sign of a persona request
+#   ("ambiguous", None) - let the LLM decide
+
+NAME = r"(?P<name>[^.,!?;:\n]+)"
+
+# Phrases that introduce a persona switch, followed by the persona
+PERSONA_PATTERNS = [
+    re.compile(r"\b(?:act|talk|speak|respond|answer|reply|behave|write)\s+(?:like|as)\s+" + NAME, re.IGNORECASE),
+    re.compile(r"\bpretend\s+(?:to\s+be|you(?:'re|\s+are))\s+" + NAME, re.IGNORECASE),
+    re.compile(r"\b(?:become|impersonate|roleplay\s+as|role-play\s+as|play\s+the\s+role\s+of)\s+" + NAME, re.IGNORECASE),
+    re.compile(r"\b(?:you\s+are\s+now|from\s+now\s+on,?\s+you(?:'re|\s+are))\s+" + NAME, re.IGNORECASE),
+    re.compile(r"^\s*(?:please\s+)?be\s+" + NAME, re.IGNORECASE),
+]
+
+# Questions about the book use the same phrases ("Why did Snape become a Death Eater?",
+# "Did Sirius act like a father to Harry?"), so a question is never settled locally.
+# The exception is a polite request: "Can you act like Hermione?"
+QUESTION_OPENER = re.compile(
+    r"^\s*(?:what|which|who|whom|whose|why|how|when|where|did|does|do|is|are|was|were|can|could|"
+    r"would|will|should|shall|has|have|had|may|might)\b",
+    re.IGNORECASE
+)
+POLITE_REQUEST = re.compile(r"^\s*(?:can|could|would|will)\s+you\s+(?:please\s+)?", re.IGNORECASE)
+
+# Words that trail the persona in requests like "act like Hermione from now on please"
+TRAILING_FILLER = re.compile(
+    r"(?:[\s,]+(?:please|pls|now|from now on|for me|for a while|instead|again|today|okay|ok))+[\s.!?]*$",
+    re.IGNORECASE
+)
+# The persona is the whole rest of the message: capitalised words ("J.K. Rowling") and the
+# particles of names like "the Dark Lord". Anything else ("Ron in class", "Snape would")
+# means the phrase is part of a longer sentence.
+NAME_WORD = re.compile(r"[A-Z][\w.'-]*|of|the|de|van|von|le|la")
+MAX_NAME_WORDS = 6
+
+# A small hand-weighted linear model over cue words. Messages that score below
+# NONE_THRESHOLD carry no hint of a persona request and skip the LLM entirely.
+CUE_WEIGHTS = {
+    "act": 2.0, "pretend": 3.0, "become": 2.5, "impersonate": 3.0, "roleplay": 3.0,
+    "role": 0.75, "persona": 3.0, "character": 0.75, "play": 0.75, "switch": 1.5,
+    "talk": 1.0, "speak": 1.0, "respond": 0.5, "answer": 0.5, "behave": 1.5,
+    "like": 0.75, "as": 0.5, "be": 0.75, "you're": 0.5, "now": 0.5,
+    # Questions about the book ("What role does Neville play...") rather than instructions
+    "what": -1.5, "which": -1.5, "who": -1.5, "why": -1.5, "how": -1.5, "when": -1.5, "where": -1.5,
+}
+CUE_BIAS = 2.5
+NONE_THRESHOLD = 0.2
+
+WORD = re.compile(r"[a-z']+")
+
+
+def persona_score(query):
+    # Probability-like score that the message asks the bot to take on a persona
+    words = set(WORD.findall(query.lower()))
+    score = sum(CUE_WEIGHTS.get(word, 0.0) for word in words)
+    return 1 / (1 + math.exp(-(score - CUE_BIAS)))
+
+
+def clean_name(rest):
+    # The name if the rest of the message is only a name and trailing filler, else None
+    name = TRAILING_FILLER.sub("", rest.strip().rstrip(".!?")).strip(" \"'")
+    words = name.split()
+    if not words or len(words) > MAX_NAME_WORDS:
+        return None
+    if not all(NAME_WORD.fullmatch(word) for word in words) or not any(word[0].isupper() for word in words):
+        return None
+    return name
+
+
+def is_question(query):
+    return query.rstrip().endswith("?") or bool(QUESTION_OPENER.match(query))
+
+
+def detect_persona(query):
+    polite = POLITE_REQUEST.match(query)
+    question = is_question(query)
+    # A request starts the message ("Act like Hermione") or directly follows "can you";
+    # anywhere else ("I always act like Ron in class") the phrase is part of a longer sentence
+    start = polite.end() if polite else len(query) - len(query.lstrip())
+    for pattern in PERSONA_PATTERNS:
+        match = pattern.search(query)
+        if not match:
+            continue
+        if match.start() != start or (question and not polite):
+            return "ambiguous", None
+        # A capitalised name ("act like Hermione Granger") is a clear request. Lower-case
+        # phrases ("act like you know", "be more specific") are left to the LLM.
+        name = clean_name(query[match.start("name"):])
+        if name:
+            return "set", name
+        return "ambiguous", None
+
+    if persona_score(query) < NONE_THRESHOLD:
+        return "none", None
+    return "ambiguous", None
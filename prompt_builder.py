@@ -0,0 +1,174 @@
+import os
+import re
+
+# Token budget for each prompt section. Tokens are estimated at ~4 characters each,
+# close enough for Gemini on English prose and free to compute.
+PROMPT_CONTEXT_TOKENS = int(os.environ.get('PROMPT_CONTEXT_TOKENS', 1500))
+PROMPT_WEB_TOKENS = int(os.environ.get('PROMPT_WEB_TOKENS', 400))
+PROMPT_HISTORY_TOKENS = int(os.environ.get('PROMPT_HISTORY_TOKENS', 600))
+CHARS_PER_TOKEN = 4
+# First line of a chat history that starts with a summary of the earlier conversation
+SUMMARY_LABEL = "Summary of the earlier conversation: "
+
+# Chunks are split with chunk_overlap=300; anything shorter is not a splitter overlap
+MIN_OVERLAP = 50
+MAX_OVERLAP = 400
+# Passages whose word 5-gram sets overlap this much are treated as the same passage
+NEAR_DUPLICATE_JACCARD = 0.8
+
+STOPWORDS = {
+    "a", "an", "the", "and", "or", "of", "to", "in", "on", "at", "for", "with", "by", "from", "is", "are",
+    "was", "were", "be", "been", "it", "its", "this", "that", "what", "which", "who", "whom", "how", "why",
+    "when", "where", "do", "does", "did", "you", "your", "i", "me", "my", "he", "she", "his", "her", "they",
+    "their", "as", "about", "can", "could", "would", "should", "tell", "name",
+}
+WORD = re.compile(r"\w+")
+SENTENCE_END = re.compile(r"(?<=[.!?])\s+|\n+")
+
+
+def estimate_tokens(text):
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def truncate_to_tokens(text, tokens):
+    limit = tokens * CHARS_PER_TOKEN
+    if len(text) <= limit:
+        return text
+    # Cut at the last word boundary inside the budget
+    cut = text.rfind(" ", 0, limit)
+    return text[:cut if cut > 0 else limit].rstrip() + " ..."
+
+
+def overlap_length(first, second):
+    # Length of the longest suffix of first that is a prefix of second, or 0
+    tail = first[-MAX_OVERLAP:]
+    probe = second[:MIN_OVERLAP]
+    start = tail.find(probe)
+    while start != -1:
+        candidate = len(tail) - start
+        if second.startswith(tail[start:]):
+            return candidate
+        start = tail.find(probe, start + 1)
+    return 0
+
+
+def merge_adjacent(passages):
+    # Stitch chunks from the same page that continue each other, keeping the retrieval
+    # rank of the best-ranked piece. passages is a list of (text, source, page).
+    merged = []
+    for text, source, page in passages:
+        for i, (other, other_source, other_page) in enumerate(merged):
+            if (source, page) != (other_source, other_page):
+                continue
+            if text in other:
+                break
+            if other in text:
+                merged[i] = (text, source, page)
+                break
+            overlap = overlap_length(other, text)
+            if overlap:
+                merged[i] = (other + text[overlap:], source, page)
+                break
+            overlap = overlap_length(text, other)
+            if overlap:
+                merged[i] = (text + other[overlap:], source, page)
+                break
+        else:
+            merged.append((text, source, page))
+    return merged
+
+
+def shingles(text, size=5):
+    words = WORD.findall(text.lower())
+    return {tuple(words[i:i + size]) for i in range(max(len(words) - size + 1, 1))}
+
+
+def drop_near_duplicates(texts):
+    kept, kept_shingles = [], []
+    for text in texts:
+        current = shingles(text)
+        if any(len(current & other) / len(current | other) >= NEAR_DUPLICATE_JACCARD for other in kept_shingles):
+            continue
+        kept.append(text)
+        kept_shingles.append(current)
+    return kept
+
+
+def build_context(docs, budget=PROMPT_CONTEXT_TOKENS):
+    # Retrieved documents, best first, merged, de-duplicated and cut to the budget
+    passages = [(d.page_content, d.metadata.get("source"), d.metadata.get("page")) for d in docs]
+    texts = drop_near_duplicates([text for text, _, _ in merge_adjacent(passages)])
+
+    selected, used = [], 0
+    for text in texts:
+        remaining = budget - used
+        if remaining <= 0:
+            break
+        text = truncate_to_tokens(text, remaining)
+        selected.append(text)
+        used += estimate_tokens(text)
+    return "\n\n".join(selected)
+
+
+def query_terms(query):
+    return {word for word in WORD.findall(query.lower()) if word not in STOPWORDS}
+
+
+def build_web_results(web_results, query, budget=PROMPT_WEB_TOKENS):
+    # Keep the sentences that share the most terms with the query, in their original order
+    if not web_results:
+        return ""
+    web_results = str(web_results)
+    if estimate_tokens(web_results) <= budget:
+        return web_results
+
+    sentences = [s.strip() for s in SENTENCE_END.split(web_results) if s.strip()]
+    terms = query_terms(query)
+    ranked = sorted(
+        range(len(sentences)),
+        key=lambda i: (-len(terms & set(WORD.findall(sentences[i].lower()))), i)
+    )
+
+    chosen, used = set(), 0
+    for i in ranked:
+        cost = estimate_tokens(sentences[i])
+        if used + cost > budget:
+            continue
+        chosen.add(i)
+        used += cost
+    if not chosen:
+        return truncate_to_tokens(sentences[ranked[0]], budget)
+    return " ".join(sentences[i] for i in sorted(chosen))
+
+
+def build_history(chat_history, budget=PROMPT_HISTORY_TOKENS):
+    # Keep the most recent messages that fit; the oldest go first. A summary of the earlier
+    # conversation (see history_summary.py) comes first and is kept, up to half the budget.
+    if estimate_tokens(chat_history) <= budget:
+        return chat_history
+    lines = chat_history.split("\n")
+    if lines[0].startswith(SUMMARY_LABEL):
+        summary = truncate_to_tokens(lines[0], budget // 2)
+        rest = build_history("\n".join(lines[1:]), budget - estimate_tokens(summary) - 1) if len(lines) > 1 else ""
+        return summary + "\n" + rest if rest else summary
+    kept, used = [], 0
+    for line in reversed(lines):
+        cost = estimate_tokens(line) + 1
+        if used + cost > budget:
+            if not kept:
+                # Even the latest message is too long; keep its end
+                kept.append("..." + line[-budget * CHARS_PER_TOKEN:])
+            break
+        kept.append(line)
+        used += cost
+    return "\n".join(reversed(kept))
+
+
+def build_prompt(prompt_template, query, character, docs, web_results, chat_history):
+    return prompt_template.format(
+        context=build_context(docs),
+        question=query,
+        web_results=build_web_results(web_results, query),
+        chat_history=build_history(chat_history),
+        character=character,
+    )
@@ -0,0 +1,91 @@
+import os
+import re
+import threading
+import time
+
+import numpy as np
+
+from caching import LRUCache, caches
+
+SEMANTIC_CACHE_THRESHOLD = float(os.environ.get('SEMANTIC_CACHE_THRESHOLD', 0.95))
+SEMANTIC_CACHE_TTL = float(os.environ.get('SEMANTIC_CACHE_TTL', 86400))
+# Answers kept per (character, corpus) and the number of (character, corpus) pairs kept
+SEMANTIC_CACHE_ENTRIES = int(os.environ.get('SEMANTIC_CACHE_ENTRIES', 256))
+SEMANTIC_CACHE_BUCKETS = int(os.environ.get('SEMANTIC_CACHE_BUCKETS', 1000))
+
+# Follow-ups that only make sense with the conversation so far ("why did he do that?",
+# "tell me more") and questions about the user ("what is my name?") must not be answered
+# from the cache
+HISTORY_DEPENDENT = re.compile(
+    r"\b(?:you said|earlier|before|again|previous|last time|more|continue|go on|that|this|it|"
+    r"he|she|they|him|her|them|his|hers|their|theirs|those|these|"
+    r"i|i'm|i've|i'd|me|my|mine|myself|we|us|our|ours|remember|recall|forget|forgot)\b",
+    re.IGNORECASE
+)
+MIN_CACHEABLE_WORDS = 3
+
+
+def history_dependent(query):
+    return len(query.split()) < MIN_CACHEABLE_WORDS or bool(HISTORY_DEPENDENT.search(query))
+
+
+class SemanticCache:
+    # Answers keyed by (character, corpus hash) and looked up by query embedding: a new question
+    # is served from the cache when its cosine similarity to a cached question is at least
+    # threshold. Buckets are LRU-evicted; entries expire after ttl and each bucket keeps at most
+    # max_entries answers, dropping the oldest.
+
+    def __init__(self, name="semantic_responses", threshold=SEMANTIC_CACHE_THRESHOLD, ttl=SEMANTIC_CACHE_TTL,
+                 max_entries=SEMANTIC_CACHE_ENTRIES, max_buckets=SEMANTIC_CACHE_BUCKETS):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._buckets = LRUCache(name + "_buckets", maxsize=max_buckets)
+        self._lock = threading.Lock()
+        caches[name] = self
+
+    @staticmethod
+    def _normalise(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def lookup(self, key, vector):
+        query = self._normalise(vector)
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            answer = None
+            if bucket:
+                # Drop expired entries, then compare against all remaining questions at once
+                bucket[:] = [entry for entry in bucket if entry[2] > now]
+                if bucket:
+                    scores = np.stack([entry[0] for entry in bucket]) @ query
+                    best = int(np.argmax(scores))
+                    if scores[best] >= self.threshold:
+                        answer = bucket[best][1]
+            if answer is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return answer
+
+    def store(self, key, vector, answer):
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = []
+                self._buckets.set(key, bucket)
+            bucket.append((self._normalise(vector), answer, time.monotonic() + self.ttl))
+            del bucket[:-self.max_entries]
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": sum(len(bucket) for bucket in self._buckets.values()),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,161 @@
+import os
+import tempfile
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import metrics
+from jobs import JOBS_DB_PATH
+
+TELEGRAM_API_URL = "https://api.telegram.org"
+TELEGRAM_POOL_SIZE = int(os.environ.get('TELEGRAM_POOL_SIZE', 20))
+TELEGRAM_TIMEOUT = float(os.environ.get('TELEGRAM_TIMEOUT', 30))
+# How many times a call is repeated after a 429, and the longest retry_after we are willing to sleep
+TELEGRAM_MAX_RATE_LIMIT_RETRIES = int(os.environ.get('TELEGRAM_MAX_RATE_LIMIT_RETRIES', 3))
+TELEGRAM_MAX_RETRY_AFTER = float(os.environ.get('TELEGRAM_MAX_RETRY_AFTER', 30))
+# Telegram limits edits to roughly one per second per chat; partial answers are edited in no more often than this
+STREAM_EDIT_INTERVAL = float(os.environ.get('STREAM_EDIT_INTERVAL', 1.5))
+TELEGRAM_MESSAGE_LIMIT = 4096
+# Downloads wait here until the job queue has processed them, so they must outlive a restart
+# just like the queue itself: the default sits next to its database, not in the temp directory
+DOWNLOAD_DIR = os.environ.get('DOWNLOAD_DIR', os.path.join(os.path.dirname(os.path.abspath(JOBS_DB_PATH)), 'downloads'))
+
+
+class TelegramClient:
+    # Bot API client on one pooled keep-alive session, shared by every thread.
+    # Connection failures are retried with backoff for all calls (nothing was sent yet);
+    # 5xx responses only for idempotent GETs, so a message is never posted twice.
+    # A 429 is retried after the retry_after Telegram asks for.
+
+    def __init__(self, token, pool_size=TELEGRAM_POOL_SIZE):
+        self.token = token
+        self.session = requests.Session()
+        retry = Retry(
+            total=3,
+            connect=3,
+            read=0,
+            backoff_factor=0.5,
+            status_forcelist=[500, 502, 503, 504],
+            allowed_methods=["GET"],
+            respect_retry_after_header=False,
+        )
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount("https://", adapter)
+
+    def _request(self, method, url, retry_rate_limit=True, **kwargs):
+        kwargs.setdefault("timeout", TELEGRAM_TIMEOUT)
+        retries = TELEGRAM_MAX_RATE_LIMIT_RETRIES if retry_rate_limit else 0
+        for attempt in range(retries + 1):
+            response = self.session.request(method, url, **kwargs)
+            if response.status_code != 429 or attempt == retries:
+                return response
+            try:
+                retry_after = response.json().get("parameters", {}).get("retry_after", 1)
+            except ValueError:
+                retry_after = 1
+            if retry_after > TELEGRAM_MAX_RETRY_AFTER:
+                return response
+            metrics.increment("telegram_rate_limited_total", method=url.rsplit('/', 1)[-1])
+            time.sleep(retry_after)
+        return response
+
+    def call(self, api_method, payload, retry_rate_limit=True):
+        url = f"{TELEGRAM_API_URL}/bot{self.token}/{api_method}"
+        return self._request("POST", url, retry_rate_limit=retry_rate_limit, json=payload)
+
+    def send_message(self, chat_id, text, parse_mode='Markdown'):
+        payload = {'chat_id': chat_id, 'text': text}
+        if parse_mode:
+            payload['parse_mode'] = parse_mode
+        return self.call("sendMessage", payload)
+
+    def edit_message_text(self, chat_id, message_id, text, parse_mode=None, retry_rate_limit=True):
+        payload = {'chat_id': chat_id, 'message_id': message_id, 'text': text}
+        if parse_mode:
+            payload['parse_mode'] = parse_mode
+        return self.call("editMessageText", payload, retry_rate_limit=retry_rate_limit)
+
+    def get_file_path(self, file_id):
+        url = f"{TELEGRAM_API_URL}/bot{self.token}/getFile"
+        file_info = self._request("GET", url, params={'file_id': file_id}).json()
+        if 'result' in file_info:
+            return file_info['result']['file_path']
+        return None
+
+    def download_file(self, file_id, directory=DOWNLOAD_DIR):
+        # Streams the file to a new uniquely named file in directory and returns its path,
+        # or None if Telegram doesn't know the file
+        file_path = self.get_file_path(file_id)
+        if not file_path:
+            return None
+
+        os.makedirs(directory, exist_ok=True)
+        url = f"{TELEGRAM_API_URL}/file/bot{self.token}/{file_path}"
+        suffix = os.path.splitext(file_path)[1]
+        with self._request("GET", url, stream=True) as response:
+            response.raise_for_status()
+            with tempfile.NamedTemporaryFile("wb", dir=directory, suffix=suffix, delete=False) as f:
+                try:
+                    for chunk in response.iter_content(chunk_size=64 * 1024):
+                        f.write(chunk)
+                except Exception:
+                    f.close()
+                    os.remove(f.name)
+                    raise
+        return f.name
+
+
+class MessageStream:
+    # Shows an answer while it is being generated: the first partial text is posted as a new
+    # message, later ones edit it in place at most every STREAM_EDIT_INTERVAL seconds, and
+    # finish() writes the final text with Markdown.
+    #
+    # Partial edits are plain text (half-written Markdown often fails to parse) and are never
+    # retried; if Telegram rate limits us we simply wait longer before the next one.
+
+    def __init__(self, client, chat_id, interval=STREAM_EDIT_INTERVAL):
+        self.client = client
+        self.chat_id = chat_id
+        self.interval = interval
+        self.message_id = None
+        self._last_edit = 0.0
+        self._shown = ""
+
+    def update(self, text):
+        text = text[:TELEGRAM_MESSAGE_LIMIT]
+        now = time.monotonic()
+        if not text.strip() or text == self._shown or now - self._last_edit < self.interval:
+            return
+        self._last_edit = now
+        try:
+            if self.message_id is None:
+                response = self.client.call("sendMessage", {'chat_id': self.chat_id, 'text': text}, retry_rate_limit=False)
+                if response.ok:
+                    self.message_id = response.json()['result']['message_id']
+            else:
+                response = self.client.edit_message_text(self.chat_id, self.message_id, text, retry_rate_limit=False)
+            if response.status_code == 429:
+                retry_after = response.json().get("parameters", {}).get("retry_after", self.interval)
+                self._last_edit = now + retry_after
+            elif response.ok:
+                self._shown = text
+        except Exception as e:
+            metrics.log_error("telegram_stream_failed", e, stage="telegram_stream", chat_id=self.chat_id)
+
+    def finish(self, text):
+        parts = [text[i:i + TELEGRAM_MESSAGE_LIMIT] for i in range(0, len(text), TELEGRAM_MESSAGE_LIMIT)] or [text]
+        if self.message_id is None:
+            response = None
+            for part in parts:
+                response = self.client.send_message(self.chat_id, part)
+            return response
+
+        response = self.client.edit_message_text(self.chat_id, self.message_id, parts[0], parse_mode='Markdown')
+        if not response.ok and "not modified" not in response.text:
+            # Usually Markdown the model got wrong; the plain text is better than nothing
+            response = self.client.edit_message_text(self.chat_id, self.message_id, parts[0])
+        for part in parts[1:]:
+            response = self.client.send_message(self.chat_id, part)
+        return response
@@ -0,0 +1,47 @@
+import pytest
+
+from persona import detect_persona
+
+
+@pytest.mark.parametrize("query", [
+    "Why did Snape become a Death Eater?",
+    "When did Lupin become a teacher at Hogwarts?",
+    "Did Sirius act like a father to Harry?",
+    "Does Dumbledore ever pretend to be someone else?",
+    "Can you tell me why Snape became a Death Eater?",
+])
+def test_questions_about_the_book_are_not_persona_requests(query):
+    assert detect_persona(query)[0] != "set"
+
+
+@pytest.mark.parametrize("query, name", [
+    ("Act like Hermione", "Hermione"),
+    ("act like Hermione Granger from now on please", "Hermione Granger"),
+    ("Pretend to be Dobby", "Dobby"),
+    ("Can you act like Hermione Granger?", "Hermione Granger"),
+    ("Could you please pretend to be Snape?", "Snape"),
+    ("You are now Albus Dumbledore", "Albus Dumbledore"),
+    ("Act like Hermione, please!", "Hermione"),
+    ("Write like J.K. Rowling", "J.K. Rowling"),
+])
+def test_clear_requests_are_settled_locally(query, name):
+    assert detect_persona(query) == ("set", name)
+
+
+@pytest.mark.parametrize("query", ["Who founded Ravenclaw House?", "What role does Neville play in the final battle?"])
+def test_ordinary_questions_skip_the_classifier(query):
+    assert detect_persona(query) == ("none", None)
+
+
+def test_lower_case_phrases_are_left_to_the_classifier():
+    assert detect_persona("act like you know the books") == ("ambiguous", None)
+
+
+@pytest.mark.parametrize("query", [
+    "I always act like Ron in class",
+    "Act like Hermione and tell me about Ron",
+    "Answer as Snape would",
+    "Sometimes I pretend to be Dobby",
+])
+def test_phrases_inside_longer_sentences_are_left_to_the_classifier(query):
+    assert detect_persona(query) == ("ambiguous", None)
@@ -0,0 +1,37 @@
+import pytest
+
+import benchmark_stubs
+from benchmark_stubs import Latencies
+
+
+@pytest.fixture(scope="module")
+def functions(tmp_path_factory):
+    latencies = Latencies(gemini=0.01, classifier=0.01, embed=0.01, vector=0.01, web=0.01, mongo=0, telegram=0)
+    functions, _ = benchmark_stubs.install(latencies, workdir=str(tmp_path_factory.mktemp("bench")))
+    for chat_id in (1, 2, 3):
+        functions.remember_character(chat_id, "Hermione Granger")
+    return functions
+
+
+def ask(functions, chat_id, question):
+    # Like app.py: the question is in the chat's history before it is answered
+    functions.manage_chat_history(chat_id, question, "user")
+    answer = functions.generate_response_with_rag(question, chat_id)
+    functions.manage_chat_history(chat_id, answer, "bot")
+    return answer
+
+
+def test_second_chat_is_served_from_the_cache(functions):
+    question = "Who founded Ravenclaw House at Hogwarts?"
+    ask(functions, 1, "Hello there, nice to meet you Hermione")
+    first = ask(functions, 1, question)
+    hits = functions.semantic_cache.hits
+    assert ask(functions, 2, question) == first
+    assert functions.semantic_cache.hits == hits + 1
+
+
+def test_follow_up_questions_skip_the_cache(functions):
+    lookups = functions.semantic_cache.hits + functions.semantic_cache.misses
+    ask(functions, 3, "What is my name?")
+    ask(functions, 3, "What is my name?")
+    assert functions.semantic_cache.hits + functions.semantic_cache.misses == lookups
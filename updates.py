@@ -0,0 +1,156 @@
+import heapq
+import os
+import queue
+import threading
+import time
+import traceback
+from collections import deque
+from contextlib import contextmanager
+
+import metrics
+
+WEBHOOK_WORKERS = int(os.environ.get('WEBHOOK_WORKERS', 8))
+# Updates waiting for a worker; beyond this the webhook answers 503 and Telegram redelivers later
+WEBHOOK_QUEUE_SIZE = int(os.environ.get('WEBHOOK_QUEUE_SIZE', 1000))
+# Messages a chat sends within COALESCE_WINDOW seconds of each other are handled as one batch,
+# but no message waits more than COALESCE_MAX_WAIT seconds for the batch to close. 0 turns it off.
+COALESCE_WINDOW = float(os.environ.get('COALESCE_WINDOW', 0.5))
+COALESCE_MAX_WAIT = float(os.environ.get('COALESCE_MAX_WAIT', 2))
+
+
+class ChatScheduler:
+    # Bounded in-process queue of parsed Telegram updates, drained by a fixed pool of threads,
+    # so slow answers never hold a webhook request open.
+    #
+    # Updates are queued per chat and each chat is handled by one worker at a time, so a chat's
+    # history and character writes happen in the order its messages arrived. A chat becomes ready
+    # once it has been quiet for COALESCE_WINDOW seconds, and its handler gets every update queued
+    # so far: handler(chat_id, updates, stale). stale() turns true as soon as newer updates
+    # arrive for the chat; whatever the handler returns is put back in front of them.
+
+    def __init__(self, handler, workers=WEBHOOK_WORKERS, maxsize=WEBHOOK_QUEUE_SIZE,
+                 window=COALESCE_WINDOW, max_wait=COALESCE_MAX_WAIT):
+        self.handler = handler
+        self.workers = workers
+        self.maxsize = maxsize
+        self.window = window
+        self.max_wait = max_wait
+        self._chats = {}  # chat_id -> [deque of updates, first arrival, last arrival]
+        self._scheduled = set()  # chats waiting in _timers or _ready, or being handled
+        self._timers = []  # heap of (due, chat_id)
+        self._ready = queue.Queue()
+        self._count = 0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._threads = []
+
+    def start(self):
+        if self._threads:
+            return
+        dispatcher = threading.Thread(target=self._dispatch, name="update-dispatcher", daemon=True)
+        dispatcher.start()
+        self._threads.append(dispatcher)
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"update-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, chat_id, update):
+        # Returns False when the queue is full
+        now = time.monotonic()
+        with self._lock:
+            if self._count >= self.maxsize:
+                return False
+            self._count += 1
+            entry = self._chats.get(chat_id)
+            if entry is None:
+                entry = self._chats[chat_id] = [deque(), now, now]
+            elif not entry[0]:
+                entry[1] = now
+            entry[0].append(update)
+            entry[2] = now
+            if chat_id not in self._scheduled:
+                self._scheduled.add(chat_id)
+                self._schedule(chat_id, now + self.window)
+        return True
+
+    def pending(self):
+        return self._count
+
+    def has_pending(self, chat_id):
+        with self._lock:
+            entry = self._chats.get(chat_id)
+            return bool(entry and entry[0])
+
+    def _schedule(self, chat_id, due):
+        # Caller holds the lock
+        heapq.heappush(self._timers, (due, chat_id))
+        self._wakeup.notify()
+
+    def _dispatch(self):
+        # Hands chats to the workers once they've been quiet for the coalescing window
+        with self._lock:
+            while True:
+                if not self._timers:
+                    self._wakeup.wait()
+                    continue
+                due, chat_id = self._timers[0]
+                now = time.monotonic()
+                if due > now:
+                    self._wakeup.wait(due - now)
+                    continue
+                heapq.heappop(self._timers)
+                _, first, last = self._chats[chat_id]
+                quiet_at = min(last + self.window, first + self.max_wait)
+                if quiet_at > now:
+                    self._schedule(chat_id, quiet_at)
+                else:
+                    self._ready.put(chat_id)
+
+    def _work(self):
+        while True:
+            chat_id = self._ready.get()
+            with self._lock:
+                updates = list(self._chats[chat_id][0])
+                self._chats[chat_id][0].clear()
+                self._count -= len(updates)
+            retry = None
+            try:
+                retry = self.handler(chat_id, updates, lambda: self.has_pending(chat_id))
+            except Exception as e:
+                metrics.log_error("update_handler_failed", e, stage="update_handler", chat_id=chat_id,
+                                  traceback=traceback.format_exc())
+            with self._lock:
+                entry = self._chats[chat_id]
+                if retry:
+                    entry[0].extendleft(reversed(retry))
+                    self._count += len(retry)
+                if entry[0]:
+                    # Newer updates arrived while we were busy; they've waited long enough
+                    self._schedule(chat_id, time.monotonic())
+                else:
+                    del self._chats[chat_id]
+                    self._scheduled.discard(chat_id)
+
+
+class ChatLocks:
+    # One lock per chat, held while a webhook request handles that chat's update inline,
+    # so two messages from the same chat are never handled at the same time
+
+    def __init__(self):
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def hold(self, chat_id):
+        with self._lock:
+            entry = self._locks.setdefault(chat_id, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._locks[chat_id]
@@ -0,0 +1,179 @@
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+import metrics
+from caching import LRUCache
+
+WEB_SEARCH_CACHE_TTL = float(os.environ.get('WEB_SEARCH_CACHE_TTL', 3600))
+WEB_SEARCH_CACHE_SIZE = int(os.environ.get('WEB_SEARCH_CACHE_SIZE', 5000))
+# Token bucket: sustained searches per second, and how many may burst at once
+WEB_SEARCH_RATE = float(os.environ.get('WEB_SEARCH_RATE', 1))
+WEB_SEARCH_BURST = int(os.environ.get('WEB_SEARCH_BURST', 5))
+# Longest a request waits for a token before going without web results
+WEB_SEARCH_RATE_WAIT = float(os.environ.get('WEB_SEARCH_RATE_WAIT', 0.5))
+WEB_SEARCH_TIMEOUT = float(os.environ.get('WEB_SEARCH_TIMEOUT', 6))
+WEB_SEARCH_CONCURRENCY = int(os.environ.get('WEB_SEARCH_CONCURRENCY', 8))
+# Consecutive failures that open the circuit, and seconds before one trial search is let through
+WEB_SEARCH_FAILURE_THRESHOLD = int(os.environ.get('WEB_SEARCH_FAILURE_THRESHOLD', 5))
+WEB_SEARCH_RESET_TIMEOUT = float(os.environ.get('WEB_SEARCH_RESET_TIMEOUT', 60))
+
+
+class DDGProvider:
+    # DuckDuckGo AI chat, falling back to instant answers.
+    # A fresh DDGS per call on purpose: chat() keeps the conversation on the instance,
+    # so a shared one would leak one user's questions into another's search.
+    name = "ddg"
+
+    def search(self, query):
+        from duckduckgo_search import DDGS
+        try:
+            return DDGS().chat(query)  # , model='claude-3-haiku')
+        except Exception:
+            answers = DDGS().answers(query)
+            return "\n".join(answer.get("text", "") for answer in answers)
+
+
+class FakeProvider:
+    # Local stand-in for tests and benchmarks: answers from a dict (or a callable) after latency seconds
+    name = "fake"
+
+    def __init__(self, answers=None, latency=0.0, default=""):
+        self.answers = answers or {}
+        self.latency = latency
+        self.default = default
+
+    def search(self, query):
+        if self.latency:
+            time.sleep(self.latency)
+        if callable(self.answers):
+            return self.answers(query)
+        return self.answers.get(query, self.default)
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, timeout=0.0):
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+                wait = (1 - self._tokens) / self.rate
+            if now + wait > deadline:
+                return False
+            time.sleep(wait)
+
+
+class CircuitBreaker:
+    # Closed: calls go through. After failure_threshold consecutive failures it opens and calls
+    # are skipped; after reset_timeout one trial call is allowed (half-open), and its result
+    # closes the circuit again or re-opens it.
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def allow(self):
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half-open" and not self._trial_running:
+                self._trial_running = True
+                return True
+            return False
+
+    def release(self):
+        # Give back a half-open trial that was allowed but never ran
+        with self._lock:
+            self._trial_running = False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_running = False
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+
+def normalize_query(query):
+    return " ".join(re.sub(r"[^\w\s]", " ", query.lower()).split())
+
+
+class WebSearch:
+    # Cached, rate-limited, time-boxed web search over a pluggable provider.
+    # Whenever a search can't be done quickly (rate limited, provider degraded, timed out,
+    # failed) it returns "" and the answer is built without web results.
+
+    def __init__(self, provider, cache_ttl=WEB_SEARCH_CACHE_TTL, rate=WEB_SEARCH_RATE, burst=WEB_SEARCH_BURST,
+                 timeout=WEB_SEARCH_TIMEOUT, concurrency=WEB_SEARCH_CONCURRENCY):
+        self.provider = provider
+        self.timeout = timeout
+        self.cache = LRUCache("web_search", maxsize=WEB_SEARCH_CACHE_SIZE, ttl=cache_ttl)
+        self.limiter = TokenBucket(rate, burst)
+        self.breaker = CircuitBreaker(WEB_SEARCH_FAILURE_THRESHOLD, WEB_SEARCH_RESET_TIMEOUT)
+        self._pool = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="web-search")
+
+    def search(self, query):
+        key = normalize_query(query)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+
+        if not self.breaker.allow():
+            metrics.increment("web_search_skipped_total", reason="circuit_open")
+            return ""
+        if not self.limiter.acquire(timeout=WEB_SEARCH_RATE_WAIT):
+            metrics.increment("web_search_skipped_total", reason="rate_limited")
+            self.breaker.release()
+            return ""
+
+        future = self._pool.submit(self.provider.search, query)
+        try:
+            results = future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            metrics.log_error("web_search_failed", f"timed out after {self.timeout}s", stage="web_search",
+                              provider=self.provider.name)
+            self.breaker.record_failure()
+            return ""
+        except Exception as e:
+            metrics.log_error("web_search_failed", e, stage="web_search", provider=self.provider.name)
+            self.breaker.record_failure()
+            return ""
+
+        self.breaker.record_success()
+        results = results or ""
+        self.cache.set(key, results)
+        return results